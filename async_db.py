@@ -0,0 +1,125 @@
+"""
+数据库异步访问层
+读操作交给小线程池执行，写操作交给单独的写线程，
+写线程把几毫秒内到达的多个写操作合并到一个事务中提交（group commit），
+避免 SQLite 查询和 fsync 阻塞 Telegram 事件循环
+
+用法：
+    p = await adb.read(db.get_product, pid)
+    oid = await adb.write(db.create_order, ...)
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import config
+import database as db
+
+logger = logging.getLogger(__name__)
+
+_read_pool = None
+_write_queue = queue.Queue()
+_writer = None
+_start_lock = threading.Lock()
+
+# 写线程统计：已提交批次数 / 写操作数
+stats = {"batches": 0, "writes": 0}
+
+def _ensure_started():
+    global _read_pool, _writer
+    if _writer is not None:
+        return
+    with _start_lock:
+        if _writer is None:
+            _read_pool = ThreadPoolExecutor(max_workers=config.DB_READ_THREADS, thread_name_prefix="db-read")
+            _writer = threading.Thread(target=_writer_loop, name="db-write", daemon=True)
+            _writer.start()
+
+def _collect_batch(first):
+    """以 first 为首，在 DB_GROUP_COMMIT_MS 毫秒内尽量多收集写操作"""
+    batch = [first]
+    deadline = time.monotonic() + config.DB_GROUP_COMMIT_MS / 1000
+    while len(batch) < config.DB_GROUP_COMMIT_MAX:
+        remaining = deadline - time.monotonic()
+        try:
+            job = _write_queue.get(timeout=remaining) if remaining > 0 else _write_queue.get_nowait()
+        except queue.Empty:
+            break
+        if job is None:
+            # 关闭信号放回队列，处理完本批后退出
+            _write_queue.put(None)
+            break
+        batch.append(job)
+    return batch
+
+def _run_batch(batch):
+    results = []
+    try:
+        # BEGIN IMMEDIATE 也可能失败（其他进程长时间持有写锁，busy_timeout 后报 database is locked），
+        # 此时整批失败返回给调用方，写线程继续运行
+        conn = db.begin_batch()
+        for fut, fn, args, kwargs in batch:
+            conn.execute(f"SAVEPOINT {db.BATCH_SAVEPOINT}")
+            try:
+                result = fn(*args, **kwargs)
+                conn.execute(f"RELEASE {db.BATCH_SAVEPOINT}")
+                results.append((fut, result, None))
+            except Exception as e:
+                # 只回滚这一个操作，不影响同批其他写入
+                conn.execute(f"ROLLBACK TO {db.BATCH_SAVEPOINT}")
+                conn.execute(f"RELEASE {db.BATCH_SAVEPOINT}")
+                results.append((fut, None, e))
+        conn.commit()
+    except Exception as e:
+        db.get_conn().rollback()
+        results = [(fut, None, e) for fut, _, _, _ in batch]
+    finally:
+        db.end_batch()
+    stats["batches"] += 1
+    stats["writes"] += len(batch)
+    for fut, result, error in results:
+        if fut.cancelled():
+            continue
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+def _writer_loop():
+    while True:
+        job = _write_queue.get()
+        if job is None:
+            return
+        try:
+            _run_batch(_collect_batch(job))
+        except Exception:
+            # 写线程退出后所有 write() 都会永久等待，任何意外都只记录日志
+            logger.exception("写线程处理批次出错")
+
+async def read(fn, *args, **kwargs):
+    """在读线程池中执行 database.py 的查询函数"""
+    _ensure_started()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_read_pool, lambda: fn(*args, **kwargs))
+
+async def write(fn, *args, **kwargs):
+    """交给写线程执行 database.py 的写函数，与同一时间窗口内的其他写操作合并提交"""
+    _ensure_started()
+    fut = Future()
+    _write_queue.put((fut, fn, args, kwargs))
+    return await asyncio.wrap_future(fut)
+
+def shutdown():
+    """等待已排队的写操作全部提交后停止线程（程序退出时调用）"""
+    global _read_pool, _writer
+    if _writer is None:
+        return
+    _write_queue.put(None)
+    _writer.join()
+    _read_pool.shutdown(wait=True)
+    _read_pool = _writer = None
+    # 写线程已退出，清掉残留的关闭信号
+    while not _write_queue.empty():
+        _write_queue.get_nowait()
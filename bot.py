@@ -3,15 +3,27 @@ TG 卖货机器人主程序
 支持：自动发货 + 人工发货 | USDT TRC20 收款 | 管理员后台
 """
 import asyncio
+import calendar
+import hashlib
+import os
+import tempfile
 import time
 import logging
+import math
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler,
+    Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler,
     MessageHandler, ContextTypes, ConversationHandler, filters
 )
 import config
 import database as db
+import async_db as adb
+import broadcast
+import callbacks
+import catalog
+import notify
+import ratelimit
+import tasks
 import tron_payment
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
@@ -25,8 +37,13 @@ logger = logging.getLogger(__name__)
     BAN_INPUT, BROADCAST_INPUT
 ) = range(13)
 
-# 支付轮询任务存储 {order_id: task}
-payment_tasks = {}
+# 订单列表每页条数
+MY_ORDERS_PAGE_SIZE = 10
+ADMIN_ORDERS_PAGE_SIZE = 20
+PENDING_DELIVER_PAGE_SIZE = 10
+
+# 待支付订单索引 {order_id: {"amount_micro", "created_ts", "user_id"}}，由 scan_payments 统一扫描
+pending_orders = {}
 
 # ============================================================
 # 工具函数
@@ -34,13 +51,31 @@ payment_tasks = {}
 def is_admin(user_id):
     return user_id in config.ADMIN_IDS
 
-def product_type_label(auto):
-    return "🤖 自动发货" if auto else "👤 人工发货"
-
 def status_label(s):
     return {"pending": "⏳ 待付款", "paid": "💰 已付款待发货",
             "delivered": "✅ 已发货", "cancelled": "❌ 已取消"}.get(s, s)
 
+async def read_page(fn, *args, limit, direction=None, cursor=None):
+    """
+    读取一页订单：direction 为 "b" 取 cursor 之前（更早）的一页，"a" 取之后（更新）的一页
+    翻页期间订单有变化导致该页为空时回到第一页
+    """
+    page = await adb.read(fn, *args, limit,
+                          before_id=cursor if direction == "b" else None,
+                          after_id=cursor if direction == "a" else None)
+    if not page[0] and cursor is not None:
+        page = await adb.read(fn, *args, limit)
+    return page
+
+def page_nav(action, rows, has_newer, has_older):
+    """上一页 / 下一页按钮行，游标为本页首尾订单 id"""
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=callbacks.encode(action, "a", rows[0]['id'])))
+    if has_older:
+        nav.append(InlineKeyboardButton("下一页 ➡️", callback_data=callbacks.encode(action, "b", rows[-1]['id'])))
+    return [nav] if nav else []
+
 def main_menu_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🛍 商品列表", callback_data="shop")],
@@ -55,97 +90,178 @@ def admin_menu_keyboard():
          InlineKeyboardButton("💰 待发货订单", callback_data="admin_pending_deliver")],
         [InlineKeyboardButton("🚫 封禁用户", callback_data="admin_ban"),
          InlineKeyboardButton("✅ 解封用户", callback_data="admin_unban")],
-        [InlineKeyboardButton("📢 广播消息", callback_data="admin_broadcast")],
+        [InlineKeyboardButton("📢 广播消息", callback_data="admin_broadcast"),
+         InlineKeyboardButton("📊 数据统计", callback_data="admin_stats")],
     ])
 
 # ============================================================
-# 支付轮询
+# 支付扫描（钱包级，单任务）
 # ============================================================
-async def poll_payment(order_id, user_id, context, created_ts):
-    timeout = config.PAYMENT_TIMEOUT * 60
-    interval = 30  # 每30秒检测一次
-    elapsed = 0
-    while elapsed < timeout:
-        await asyncio.sleep(interval)
-        elapsed += interval
-        order = db.get_order(order_id)
-        if not order or order['status'] != 'pending':
+def track_order(order_id, amount_micro, created_ts, user_id):
+    """加入待支付索引，由 scan_payments 统一检测到账与超时"""
+    pending_orders[order_id] = {"amount_micro": amount_micro, "created_ts": created_ts, "user_id": user_id}
+
+def untrack_order(order_id):
+    """从待支付索引移除订单并释放其应付金额"""
+    info = pending_orders.pop(order_id, None)
+    if info:
+        tron_payment.release_amount(info['amount_micro'], order_id)
+    return info
+
+async def deliver_paid_order(order, context):
+    """
+    订单到账（已标记付款）后：自动发货或转人工
+    管理员通知先在后台发出，不依赖买家消息是否发送成功（买家拉黑机器人、Markdown 解析失败等）
+    """
+    order_id = order['id']
+    user_id = order['user_id']
+    deliver_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"📤 发货 #{order_id}", callback_data=callbacks.encode("do_deliver", order_id))
+    ]])
+    if order['auto_delivery']:
+        card = await adb.write(db.claim_card, order['product_id'], order_id)
+        if card:
+            # 通知管理员
+            notify.admins(
+                context.bot, "auto", order_id,
+                f"🤖 自动发货成功\n订单#{order_id}\n用户：@{order['username']}\n商品：{order['product_name']}\n金额：{order['amount']} USDT"
+            )
+            await context.bot.send_message(
+                user_id,
+                f"✅ *付款成功，自动发货！*\n\n"
+                f"商品：{order['product_name']}\n"
+                f"内容：\n`{card['content']}`\n\n"
+                f"感谢购买！有问题请联系 {config.CUSTOMER_SERVICE}",
+                parse_mode="Markdown"
+            )
+        else:
+            # 库存不足，转人工
+            notify.admins(
+                context.bot, "shortage", order_id,
+                f"⚠️ 库存不足！需人工处理\n订单#{order_id}\n用户：@{order['username']}\n商品：{order['product_name']}\n金额：{order['amount']} USDT",
+                reply_markup=deliver_markup
+            )
+            await context.bot.send_message(
+                user_id,
+                f"✅ *付款成功！*\n\n很抱歉，库存暂时不足，已转人工处理。\n客服：{config.CUSTOMER_SERVICE}\n订单号：#{order_id}",
+                parse_mode="Markdown"
+            )
+    else:
+        # 人工发货
+        notify.admins(
+            context.bot, "manual", order_id,
+            f"💰 收到付款！需人工发货\n订单#{order_id}\n用户：@{order['username']} (ID:{user_id})\n商品：{order['product_name']}\n金额：{order['amount']} USDT",
+            reply_markup=deliver_markup
+        )
+        await context.bot.send_message(
+            user_id,
+            f"✅ *付款成功！*\n\n订单号：#{order_id}\n商品：{order['product_name']}\n\n客服将尽快为您发货，请等待。\n客服：{config.CUSTOMER_SERVICE}",
+            parse_mode="Markdown"
+        )
+
+async def sync_transfers():
+    """
+    从持久化游标（区块时间）向前翻页拉取新转账，
+    每页批量写入 transfers 表并推进游标，tx_id 重复的转账自动跳过
+    """
+    cursor_ts, fingerprint = await adb.read(db.get_scan_cursor)
+    # 早于支付超时窗口的转账不可能再匹配任何待支付订单
+    floor_ts = int((time.time() - config.PAYMENT_TIMEOUT * 60) * 1000)
+    if cursor_ts is None or cursor_ts < floor_ts:
+        cursor_ts, fingerprint = floor_ts, None
+    newest_ts = cursor_ts
+    for _ in range(config.TRONGRID_MAX_PAGES):
+        page = await tron_payment.get_usdt_transfers_page_async(config.USDT_WALLET, cursor_ts, fingerprint)
+        if page is None:
             return
-        if tron_payment.check_payment(order_id, order['amount'], created_ts):
-            db.mark_order_paid(order_id)
-            if order['auto_delivery']:
-                card = db.get_available_card(order['product_id'])
-                if card:
-                    db.mark_card_used(card['id'], order_id)
-                    db.update_stock_count(order['product_id'])
-                    db.mark_order_delivered(order_id, card['content'])
-                    await context.bot.send_message(
-                        user_id,
-                        f"✅ *付款成功，自动发货！*\n\n"
-                        f"商品：{order['product_name']}\n"
-                        f"内容：\n`{card['content']}`\n\n"
-                        f"感谢购买！有问题请联系 {config.CUSTOMER_SERVICE}",
-                        parse_mode="Markdown"
-                    )
-                    # 通知管理员
-                    for admin_id in config.ADMIN_IDS:
-                        try:
-                            await context.bot.send_message(
-                                admin_id,
-                                f"🤖 自动发货成功\n订单#{order_id}\n用户：@{order['username']}\n商品：{order['product_name']}\n金额：{order['amount']} USDT"
-                            )
-                        except:
-                            pass
-                else:
-                    # 库存不足，转人工
-                    db.mark_order_paid(order_id)
-                    await context.bot.send_message(
-                        user_id,
-                        f"✅ *付款成功！*\n\n很抱歉，库存暂时不足，已转人工处理。\n客服：{config.CUSTOMER_SERVICE}\n订单号：#{order_id}",
-                        parse_mode="Markdown"
-                    )
-                    for admin_id in config.ADMIN_IDS:
-                        try:
-                            await context.bot.send_message(
-                                admin_id,
-                                f"⚠️ 库存不足！需人工处理\n订单#{order_id}\n用户：@{order['username']}\n商品：{order['product_name']}\n金额：{order['amount']} USDT",
-                                reply_markup=InlineKeyboardMarkup([[
-                                    InlineKeyboardButton(f"📤 发货 #{order_id}", callback_data=f"do_deliver_{order_id}")
-                                ]])
-                            )
-                        except:
-                            pass
-            else:
-                # 人工发货
-                await context.bot.send_message(
-                    user_id,
-                    f"✅ *付款成功！*\n\n订单号：#{order_id}\n商品：{order['product_name']}\n\n客服将尽快为您发货，请等待。\n客服：{config.CUSTOMER_SERVICE}",
-                    parse_mode="Markdown"
-                )
-                for admin_id in config.ADMIN_IDS:
-                    try:
-                        await context.bot.send_message(
-                            admin_id,
-                            f"💰 收到付款！需人工发货\n订单#{order_id}\n用户：@{order['username']} (ID:{user_id})\n商品：{order['product_name']}\n金额：{order['amount']} USDT",
-                            reply_markup=InlineKeyboardMarkup([[
-                                InlineKeyboardButton(f"📤 发货 #{order_id}", callback_data=f"do_deliver_{order_id}")
-                            ]])
-                        )
-                    except:
-                        pass
+        data, fingerprint = page
+        rows = [r for r in map(tron_payment.parse_transfer, data) if r]
+        newest_ts = max([newest_ts] + [r[3] for r in rows])
+        # 页内按区块时间正序，每页都把游标推进到已拉取的最新时间；
+        # fingerprint 只在本轮内翻页使用，不持久化，下一轮从新游标重新查询（同一时间的转账按 tx_id 去重）
+        await adb.write(db.save_transfers, rows, newest_ts, None)
+        if not fingerprint:
             return
-    # 超时
-    order = db.get_order(order_id)
-    if order and order['status'] == 'pending':
-        db.cancel_order(order_id)
-        await context.bot.send_message(user_id, f"⏰ 订单 #{order_id} 已超时取消，如已付款请联系 {config.CUSTOMER_SERVICE}")
+
+def restore_pending_orders():
+    """
+    启动时从数据库恢复待支付订单索引（重启后继续监听）
+    沿用订单原始 created_at 计算超时，只重建内存索引，不为每个订单启动任务
+    """
+    restored = 0
+    for o in db.get_pending_orders():
+        amount_micro = tron_payment.to_micro(o['amount'])
+        if not tron_payment.restore_amount(amount_micro, o['id']):
+            logger.warning(f"订单#{o['id']} 应付金额 {o['amount']} 与其他待支付订单重复，无法自动匹配到账")
+        # created_at 为 SQLite CURRENT_TIMESTAMP（UTC）
+        created_ts = calendar.timegm(time.strptime(o['created_at'], "%Y-%m-%d %H:%M:%S"))
+        track_order(o['id'], amount_micro, created_ts, o['user_id'])
+        restored += 1
+    logger.info(f"已恢复 {restored} 个待支付订单")
+
+async def flush_users(context=None):
+    """JobQueue 定时任务：把缓冲的用户资料合并成一次批量写入"""
+    rows = db.take_pending_users()
+    if not rows:
+        return
+    try:
+        await adb.write(db.upsert_users, rows)
+    except Exception as e:
+        db.requeue_users(rows)
+        logger.error(f"用户资料写入失败，稍后重试: {e}")
+        return
+    db.mark_users_written(rows)
+
+async def sync_banned_ids(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue 定时任务：与数据库核对封禁名单，发现其他进程直接修改数据库的情况"""
+    # 经写线程执行，与 ban_user 串行，不会覆盖并发的封禁 / 解封
+    added, removed = await adb.write(db.load_banned_ids)
+    if added or removed:
+        logger.warning(f"封禁名单与数据库不一致，已同步：新增 {sorted(added)}，移除 {sorted(removed)}")
+
+async def scan_payments(context: ContextTypes.DEFAULT_TYPE):
+    """
+    JobQueue 定时任务：每轮只从游标处增量拉取一次 TronGrid，
+    再与内存中的全部待支付订单匹配，API 调用量与订单数无关
+    """
+    if not pending_orders:
+        return
+    await sync_transfers()
+    since_ts = int((time.time() - config.PAYMENT_TIMEOUT * 60) * 1000)
+    transfers = await adb.read(db.get_unconsumed_transfers, since_ts)
+    for order_id, tx_id in tron_payment.match_transfers(transfers, pending_orders):
+        # 转账绑定订单与标记已付款在同一事务，一笔转账只能被一个订单使用
+        if not await adb.write(db.consume_transfer, tx_id, order_id):
+            continue
+        untrack_order(order_id)
+        order = await adb.read(db.get_order, order_id)
+        try:
+            await deliver_paid_order(order, context)
+        except Exception as e:
+            logger.error(f"订单#{order_id} 发货处理失败: {e}")
+
+    # 先匹配到账再处理超时，临近超时才到账的订单不会被误取消
+    await expire_orders(context)
+
+async def expire_orders(context):
+    """一条 UPDATE ... RETURNING 批量取消所有超时的待支付订单，超时通知交给后台限速发送"""
+    cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - config.PAYMENT_TIMEOUT * 60))
+    expired = await adb.write(db.expire_pending_orders, cutoff)
+    for row in expired:
+        untrack_order(row['id'])
+    if expired:
+        logger.info(f"{len(expired)} 个订单超时取消")
+    notify.users(context.bot, [
+        (row['user_id'], f"⏰ 订单 #{row['id']} 已超时取消，如已付款请联系 {config.CUSTOMER_SERVICE}")
+        for row in expired
+    ])
 
 # ============================================================
 # 用户命令
 # ============================================================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    db.upsert_user(user.id, user.username or "", user.first_name or "")
+    db.touch_user(user.id, user.username or "", user.first_name or "")
     if db.is_banned(user.id):
         await update.message.reply_text("❌ 您已被封禁，请联系客服。")
         return
@@ -161,103 +277,136 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await update.message.reply_text("🛠 *管理员后台*", parse_mode="Markdown", reply_markup=admin_menu_keyboard())
 
+async def repair_stock_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/repair_stock：按卡密表重新核对所有商品库存"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ 无权限")
+        return
+    fixed = await adb.write(db.reconcile_stock_counts)
+    await update.message.reply_text(f"✅ 库存核对完成，修正 {fixed} 个商品")
+
+async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/status：后台任务与写线程统计"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ 无权限")
+        return
+    c = tasks.counts()
+    await update.message.reply_text(
+        f"📊 *运行状态*\n\n"
+        f"待支付订单：{len(pending_orders)}\n"
+        f"后台任务：运行中 {c['running']} | 完成 {c['completed']} | 失败 {c['failed']} | 取消 {c['cancelled']}\n"
+        f"进行中的广播：{len(broadcast.running)}\n"
+        f"数据库写入：{adb.stats['writes']} 次 / {adb.stats['batches']} 批",
+        parse_mode="Markdown"
+    )
+
 # ============================================================
 # 商品列表
 # ============================================================
+@callbacks.route("shop")
 async def show_shop(query, context):
-    products = db.get_products()
-    if not products:
+    shop = (await catalog.snapshot())["shop"]
+    if not shop:
         await query.edit_message_text("暂无商品，请稍后再来 🙏")
         return
-    keyboard = []
-    for p in products:
-        stock_info = f" (库存:{p['stock_count']})" if p['auto_delivery'] else ""
-        label = f"{'🤖' if p['auto_delivery'] else '👤'} {p['name']} - {p['price']} USDT{stock_info}"
-        keyboard.append([InlineKeyboardButton(label, callback_data=f"product_{p['id']}")])
-    keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
-    await query.edit_message_text("🛍 *请选择商品：*", parse_mode="Markdown",
-                                   reply_markup=InlineKeyboardMarkup(keyboard))
+    text, keyboard = shop
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
 
+@callbacks.route("product")
 async def show_product_detail(query, context, pid):
-    p = db.get_product(pid)
-    if not p:
+    detail = (await catalog.snapshot())["details"].get(pid)
+    if not detail:
         await query.edit_message_text("商品不存在")
         return
-    stock_text = f"\n📦 库存：{p['stock_count']} 件" if p['auto_delivery'] else ""
-    text = (f"*{p['name']}*\n\n"
-            f"📝 {p['description'] or '暂无描述'}\n"
-            f"💰 价格：{p['price']} USDT\n"
-            f"🚀 {product_type_label(p['auto_delivery'])}{stock_text}")
-    keyboard = [
-        [InlineKeyboardButton("🛒 立即购买", callback_data=f"buy_{pid}")],
-        [InlineKeyboardButton("🔙 返回商品列表", callback_data="shop")]
-    ]
-    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
+    text, keyboard = detail
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
 
 # ============================================================
 # 购买流程
 # ============================================================
+@callbacks.route("buy", kind="write")
 async def handle_buy(query, context, pid):
     user = query.from_user
     if db.is_banned(user.id):
         await query.answer("您已被封禁")
         return
-    p = db.get_product(pid)
+    p = await catalog.get_product(pid)
     if not p:
         await query.edit_message_text("商品不存在")
         return
+    # 只统计仍在监听中的订单，已超时待清理的不算
+    open_orders = [o for o in await adb.read(db.get_user_pending_orders, user.id) if o['id'] in pending_orders]
+    # 同一商品已有待支付订单：直接返回原订单，不重复下单（同一用户的更新串行处理，不会并发重复创建）
+    for o in open_orders:
+        if o['product_id'] == pid:
+            info = pending_orders[o['id']]
+            await show_payment(query, o['id'], info['amount_micro'], info['created_ts'])
+            return
+    if len(open_orders) >= config.MAX_PENDING_ORDERS_PER_USER:
+        await query.edit_message_text(
+            f"⏳ 您已有 {len(open_orders)} 个待支付订单，请先完成付款或取消后再下单。",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📋 我的订单", callback_data="my_orders")]])
+        )
+        return
     if p['auto_delivery'] and p['stock_count'] <= 0:
         await query.edit_message_text("❌ 该商品库存不足，请选择其他商品或联系客服。")
         return
 
-    order_id = db.create_order(user.id, user.username or str(user.id),
-                               pid, p['name'], p['price'], p['auto_delivery'])
+    # 分配唯一应付金额，用于区分同价商品的并发订单
+    amount_micro = tron_payment.allocate_amount(p['price'])
+    if amount_micro is None:
+        await query.edit_message_text("⏳ 当前下单人数过多，请稍后再试。")
+        return
+    try:
+        order_id = await adb.write(db.create_order, user.id, user.username or str(user.id),
+                                   pid, p['name'], amount_micro / 1_000_000, p['auto_delivery'])
+    except Exception:
+        tron_payment.release_amount(amount_micro)
+        raise
+    tron_payment.assign_amount(amount_micro, order_id)
     created_ts = time.time()
+    track_order(order_id, amount_micro, created_ts, user.id)
+    await show_payment(query, order_id, amount_micro, created_ts)
 
+async def show_payment(query, order_id, amount_micro, created_ts):
+    """显示付款信息，超时时间按订单创建时间计算剩余分钟数"""
+    remaining = created_ts + config.PAYMENT_TIMEOUT * 60 - time.time()
     text = config.PAYMENT_TEXT.format(
-        timeout=config.PAYMENT_TIMEOUT,
-        amount=p['price'],
+        timeout=max(1, math.ceil(remaining / 60)),
+        amount=tron_payment.format_amount(amount_micro),
         address=config.USDT_WALLET
     )
     keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("❌ 取消订单", callback_data=f"cancel_order_{order_id}")]
+        [InlineKeyboardButton("❌ 取消订单", callback_data=callbacks.encode("cancel_order", order_id))]
     ])
     await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
 
-    # 启动支付轮询
-    task = asyncio.create_task(poll_payment(order_id, user.id, context, created_ts))
-    payment_tasks[order_id] = task
-
 # ============================================================
 # 我的订单
 # ============================================================
-async def show_my_orders(query, context):
-    orders = db.get_user_orders(query.from_user.id)
+@callbacks.route("my_orders")
+async def show_my_orders(query, context, direction=None, cursor=None):
+    orders, has_newer, has_older = await read_page(db.get_user_orders_page, query.from_user.id,
+                                                   limit=MY_ORDERS_PAGE_SIZE, direction=direction, cursor=cursor)
+    back = [InlineKeyboardButton("🔙 返回", callback_data="back_home")]
     if not orders:
-        await query.edit_message_text("您还没有任何订单。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
+        await query.edit_message_text("您还没有任何订单。", reply_markup=InlineKeyboardMarkup([back]))
         return
-    lines = ["📋 *我的订单（最近10条）*\n"]
+    lines = ["📋 *我的订单*\n"]
     for o in orders:
         lines.append(f"#{o['id']} {o['product_name']} {o['amount']}U - {status_label(o['status'])}")
         if o['status'] == 'delivered' and o['delivery_content']:
             lines.append(f"  📦 发货内容：`{o['delivery_content']}`")
     text = "\n".join(lines)
-    await query.edit_message_text(text, parse_mode="Markdown",
-                                   reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
+    keyboard = page_nav("my_orders", orders, has_newer, has_older) + [back]
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
 
 # ============================================================
 # 管理员：商品管理
 # ============================================================
+@callbacks.route("admin_products", admin=True)
 async def admin_show_products(query, context):
-    products = db.get_products(enabled_only=False)
-    if not products:
-        text = "暂无商品"
-    else:
-        lines = ["📦 *商品列表：*\n"]
-        for p in products:
-            status = "✅" if p['enabled'] else "🔴"
-            lines.append(f"{status} #{p['id']} {p['name']} - {p['price']}U | {product_type_label(p['auto_delivery'])} | 库存:{p['stock_count']}")
-        text = "\n".join(lines)
+    text = (await catalog.snapshot())["admin_products"]
     keyboard = [
         [InlineKeyboardButton("➕ 添加商品", callback_data="admin_add_product")],
         [InlineKeyboardButton("✏️ 修改价格", callback_data="admin_set_price")],
@@ -270,20 +419,25 @@ async def admin_show_products(query, context):
 # ============================================================
 # 管理员：所有订单
 # ============================================================
-async def admin_show_orders(query, context):
-    orders = db.get_all_orders(20)
+@callbacks.route("admin_orders", admin=True)
+async def admin_show_orders(query, context, direction=None, cursor=None):
+    orders, has_newer, has_older = await read_page(db.get_orders_page, limit=ADMIN_ORDERS_PAGE_SIZE,
+                                                   direction=direction, cursor=cursor)
     if not orders:
         text = "暂无订单"
     else:
-        lines = ["📋 *最近20条订单：*\n"]
+        lines = ["📋 *所有订单：*\n"]
         for o in orders:
             lines.append(f"#{o['id']} @{o['username']} {o['product_name']} {o['amount']}U {status_label(o['status'])}")
         text = "\n".join(lines)
-    await query.edit_message_text(text, parse_mode="Markdown",
-                                   reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_home")]]))
+    keyboard = page_nav("admin_orders", orders, has_newer, has_older)
+    keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="admin_home")])
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
 
-async def admin_show_pending_deliver(query, context):
-    orders = db.get_paid_orders()
+@callbacks.route("admin_pending_deliver", admin=True)
+async def admin_show_pending_deliver(query, context, direction=None, cursor=None):
+    orders, has_newer, has_older = await read_page(db.get_paid_orders_page, limit=PENDING_DELIVER_PAGE_SIZE,
+                                                   direction=direction, cursor=cursor)
     if not orders:
         await query.edit_message_text("✅ 暂无待发货订单",
                                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_home")]]))
@@ -292,110 +446,133 @@ async def admin_show_pending_deliver(query, context):
     for o in orders:
         keyboard.append([InlineKeyboardButton(
             f"📤 #{o['id']} @{o['username']} {o['product_name']} {o['amount']}U",
-            callback_data=f"do_deliver_{o['id']}"
+            callback_data=callbacks.encode("do_deliver", o['id'])
         )])
+    keyboard += page_nav("admin_pending_deliver", orders, has_newer, has_older)
     keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="admin_home")])
     await query.edit_message_text("💰 *待发货订单：*", parse_mode="Markdown",
                                    reply_markup=InlineKeyboardMarkup(keyboard))
 
 # ============================================================
-# 主 CallbackQuery 路由
+# 管理员：数据统计
 # ============================================================
-async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-
-    if data == "back_home" or data == "start":
-        await query.edit_message_text(config.WELCOME_TEXT, parse_mode="Markdown", reply_markup=main_menu_keyboard())
-    elif data == "admin_home":
-        await query.edit_message_text("🛠 *管理员后台*", parse_mode="Markdown", reply_markup=admin_menu_keyboard())
-    elif data == "shop":
-        await show_shop(query, context)
-    elif data == "my_orders":
-        await show_my_orders(query, context)
-    elif data.startswith("product_"):
-        await show_product_detail(query, context, int(data.split("_")[1]))
-    elif data.startswith("buy_"):
-        await handle_buy(query, context, int(data.split("_")[1]))
-    elif data.startswith("cancel_order_"):
-        oid = int(data.split("_")[2])
-        order = db.get_order(oid)
-        if order and order['status'] == 'pending' and order['user_id'] == query.from_user.id:
-            db.cancel_order(oid)
-            if oid in payment_tasks:
-                payment_tasks[oid].cancel()
-            await query.edit_message_text("❌ 订单已取消", reply_markup=main_menu_keyboard())
-        else:
-            await query.edit_message_text("订单无法取消（已付款或不存在）")
-
-    # ===== 管理员 =====
-    elif data == "admin_products" and is_admin(query.from_user.id):
-        await admin_show_products(query, context)
-    elif data == "admin_orders" and is_admin(query.from_user.id):
-        await admin_show_orders(query, context)
-    elif data == "admin_pending_deliver" and is_admin(query.from_user.id):
-        await admin_show_pending_deliver(query, context)
-    elif data.startswith("do_deliver_") and is_admin(query.from_user.id):
-        oid = int(data.split("_")[2])
-        context.user_data['deliver_order_id'] = oid
-        await query.edit_message_text(f"📤 请发送订单 #{oid} 的发货内容（账号密码等），直接回复即可：")
-        context.user_data['state'] = 'delivering'
-    elif data == "admin_ban" and is_admin(query.from_user.id):
-        await query.edit_message_text("请发送要封禁的用户 ID（数字）：")
-        context.user_data['state'] = 'banning'
-    elif data == "admin_unban" and is_admin(query.from_user.id):
-        await query.edit_message_text("请发送要解封的用户 ID（数字）：")
-        context.user_data['state'] = 'unbanning'
-    elif data == "admin_add_product" and is_admin(query.from_user.id):
-        await query.edit_message_text("请发送新商品名称：")
-        context.user_data['state'] = 'add_product_name'
-        context.user_data['new_product'] = {}
-    elif data == "admin_set_price" and is_admin(query.from_user.id):
-        products = db.get_products(enabled_only=False)
-        keyboard = [[InlineKeyboardButton(f"#{p['id']} {p['name']}", callback_data=f"setprice_{p['id']}")] for p in products]
-        await query.edit_message_text("选择要修改价格的商品：", reply_markup=InlineKeyboardMarkup(keyboard))
-    elif data.startswith("setprice_") and is_admin(query.from_user.id):
-        pid = int(data.split("_")[1])
-        context.user_data['set_price_pid'] = pid
-        context.user_data['state'] = 'set_price_input'
-        await query.edit_message_text(f"请发送商品 #{pid} 的新价格（USDT）：")
-    elif data == "admin_toggle_product" and is_admin(query.from_user.id):
-        products = db.get_products(enabled_only=False)
-        keyboard = [[InlineKeyboardButton(
-            f"{'✅' if p['enabled'] else '🔴'} #{p['id']} {p['name']}",
-            callback_data=f"toggle_{p['id']}_{0 if p['enabled'] else 1}"
-        )] for p in products]
-        await query.edit_message_text("点击切换商品上架/下架：", reply_markup=InlineKeyboardMarkup(keyboard))
-    elif data.startswith("toggle_") and is_admin(query.from_user.id):
-        parts = data.split("_")
-        pid, enabled = int(parts[1]), int(parts[2])
-        db.toggle_product(pid, enabled)
-        await query.edit_message_text(f"商品 #{pid} 已{'上架' if enabled else '下架'}")
-    elif data == "admin_delete_product" and is_admin(query.from_user.id):
-        products = db.get_products(enabled_only=False)
-        keyboard = [[InlineKeyboardButton(f"🗑 #{p['id']} {p['name']}", callback_data=f"delproduct_{p['id']}")] for p in products]
-        await query.edit_message_text("⚠️ 选择要删除的商品（同时删除所有卡密）：", reply_markup=InlineKeyboardMarkup(keyboard))
-    elif data.startswith("delproduct_") and is_admin(query.from_user.id):
-        pid = int(data.split("_")[1])
-        db.delete_product(pid)
-        await query.edit_message_text(f"✅ 商品 #{pid} 已删除")
-    elif data == "admin_cards" and is_admin(query.from_user.id):
-        products = db.get_products(enabled_only=False)
-        auto_products = [p for p in products if p['auto_delivery']]
-        if not auto_products:
-            await query.edit_message_text("暂无自动发货商品，请先添加")
-            return
-        keyboard = [[InlineKeyboardButton(f"#{p['id']} {p['name']} (库存:{p['stock_count']})", callback_data=f"addcards_{p['id']}")] for p in auto_products]
-        await query.edit_message_text("选择要添加卡密的商品：", reply_markup=InlineKeyboardMarkup(keyboard))
-    elif data.startswith("addcards_") and is_admin(query.from_user.id):
-        pid = int(data.split("_")[1])
-        context.user_data['add_cards_pid'] = pid
-        context.user_data['state'] = 'add_cards_input'
-        await query.edit_message_text(f"请发送卡密内容（每行一条，可批量粘贴）：")
-    elif data == "admin_broadcast" and is_admin(query.from_user.id):
-        await query.edit_message_text("请发送广播消息内容（将发送给所有用户）：")
-        context.user_data['state'] = 'broadcasting'
+@callbacks.route("admin_stats", admin=True)
+async def admin_show_stats(query, context):
+    stats = await adb.read(db.get_stats)
+    days = await adb.read(db.get_daily_stats, 7)
+    products = await adb.read(db.get_product_stats, 30)
+    lines = [
+        "📊 *数据统计*\n",
+        f"👥 总用户：{stats['total_users']}",
+        f"📦 总订单：{stats['total_orders']}（已付款 {stats['paid_orders']}，已取消 {stats['cancelled_orders']}）",
+        f"💰 总收入：{stats['total_revenue']:.2f} USDT",
+        f"⏳ 待付款：{stats['pending_orders']} | 待发货：{stats['awaiting_delivery']}",
+        "\n📅 *最近 7 天*",
+    ]
+    for d in days:
+        lines.append(f"{d['day']}  订单 {d['orders']}  付款 {d['paid']}  收入 {d['revenue_micro'] / 1_000_000:.2f}U  新用户 {d['new_users']}")
+    if products:
+        lines.append("\n🏆 *近 30 天商品收入*")
+        for p in products[:10]:
+            lines.append(f"{p['name'] or '#' + str(p['product_id'])}  {p['paid']} 单  {p['revenue_micro'] / 1_000_000:.2f}U")
+    await query.edit_message_text("\n".join(lines), parse_mode="Markdown",
+                                   reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_home")]]))
+
+# ============================================================
+# 按钮回调（callbacks.route 登记，callbacks.dispatch 统一分发）
+# ============================================================
+@callbacks.route("back_home")
+@callbacks.route("start")
+async def cb_home(query, context):
+    await query.edit_message_text(config.WELCOME_TEXT, parse_mode="Markdown", reply_markup=main_menu_keyboard())
+
+@callbacks.route("cancel_order")
+async def cb_cancel_order(query, context, oid):
+    order = await adb.read(db.get_order, oid)
+    # 读取与取消之间可能被扫描确认到账，以 cancel_order 的条件更新结果为准
+    if (order and order['status'] == 'pending' and order['user_id'] == query.from_user.id
+            and await adb.write(db.cancel_order, oid)):
+        untrack_order(oid)
+        await query.edit_message_text("❌ 订单已取消", reply_markup=main_menu_keyboard())
+    else:
+        await query.edit_message_text("订单无法取消（已付款或不存在）")
+
+# ===== 管理员 =====
+@callbacks.route("admin_home", admin=True)
+async def cb_admin_home(query, context):
+    await query.edit_message_text("🛠 *管理员后台*", parse_mode="Markdown", reply_markup=admin_menu_keyboard())
+
+@callbacks.route("do_deliver", admin=True)
+async def cb_do_deliver(query, context, oid):
+    context.user_data['deliver_order_id'] = oid
+    await query.edit_message_text(f"📤 请发送订单 #{oid} 的发货内容（账号密码等），直接回复即可：")
+    context.user_data['state'] = 'delivering'
+
+@callbacks.route("admin_ban", admin=True)
+async def cb_admin_ban(query, context):
+    await query.edit_message_text("请发送要封禁的用户 ID（数字）：")
+    context.user_data['state'] = 'banning'
+
+@callbacks.route("admin_unban", admin=True)
+async def cb_admin_unban(query, context):
+    await query.edit_message_text("请发送要解封的用户 ID（数字）：")
+    context.user_data['state'] = 'unbanning'
+
+@callbacks.route("admin_add_product", admin=True)
+async def cb_admin_add_product(query, context):
+    await query.edit_message_text("请发送新商品名称：")
+    context.user_data['state'] = 'add_product_name'
+    context.user_data['new_product'] = {}
+
+@callbacks.route("admin_set_price", admin=True)
+async def cb_admin_set_price(query, context):
+    keyboard = (await catalog.snapshot())["set_price"]
+    await query.edit_message_text("选择要修改价格的商品：", reply_markup=keyboard)
+
+@callbacks.route("setprice", admin=True)
+async def cb_setprice(query, context, pid):
+    context.user_data['set_price_pid'] = pid
+    context.user_data['state'] = 'set_price_input'
+    await query.edit_message_text(f"请发送商品 #{pid} 的新价格（USDT）：")
+
+@callbacks.route("admin_toggle_product", admin=True)
+async def cb_admin_toggle_product(query, context):
+    keyboard = (await catalog.snapshot())["toggle"]
+    await query.edit_message_text("点击切换商品上架/下架：", reply_markup=keyboard)
+
+@callbacks.route("toggle", admin=True)
+async def cb_toggle(query, context, pid, enabled):
+    await adb.write(db.toggle_product, pid, enabled)
+    await query.edit_message_text(f"商品 #{pid} 已{'上架' if enabled else '下架'}")
+
+@callbacks.route("admin_delete_product", admin=True)
+async def cb_admin_delete_product(query, context):
+    keyboard = (await catalog.snapshot())["delete"]
+    await query.edit_message_text("⚠️ 选择要删除的商品（同时删除所有卡密）：", reply_markup=keyboard)
+
+@callbacks.route("delproduct", admin=True)
+async def cb_delproduct(query, context, pid):
+    await adb.write(db.delete_product, pid)
+    await query.edit_message_text(f"✅ 商品 #{pid} 已删除")
+
+@callbacks.route("admin_cards", admin=True)
+async def cb_admin_cards(query, context):
+    keyboard = (await catalog.snapshot())["cards"]
+    if not keyboard:
+        await query.edit_message_text("暂无自动发货商品，请先添加")
+        return
+    await query.edit_message_text("选择要添加卡密的商品：", reply_markup=keyboard)
+
+@callbacks.route("addcards", admin=True)
+async def cb_addcards(query, context, pid):
+    context.user_data['add_cards_pid'] = pid
+    context.user_data['state'] = 'add_cards_input'
+    await query.edit_message_text(f"请发送卡密内容（每行一条，可批量粘贴），大批量请直接上传 .txt / .csv 文件：")
+
+@callbacks.route("admin_broadcast", admin=True)
+async def cb_admin_broadcast(query, context):
+    await query.edit_message_text("请发送广播消息内容（将发送给所有用户）：")
+    context.user_data['state'] = 'broadcasting'
 
 # ============================================================
 # 文字消息处理（状态机）
@@ -403,14 +580,16 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if db.is_banned(update.effective_user.id):
         return
+    if not ratelimit.allow(update.effective_user.id, "read"):
+        return
     state = context.user_data.get('state')
     text = update.message.text.strip()
 
     if state == 'delivering' and is_admin(update.effective_user.id):
         oid = context.user_data.get('deliver_order_id')
-        order = db.get_order(oid)
+        order = await adb.read(db.get_order, oid)
         if order:
-            db.mark_order_delivered(oid, text)
+            await adb.write(db.mark_order_delivered, oid, text)
             try:
                 await context.bot.send_message(
                     order['user_id'],
@@ -425,7 +604,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif state == 'banning' and is_admin(update.effective_user.id):
         try:
             uid = int(text)
-            db.ban_user(uid, True)
+            await adb.write(db.ban_user, uid, True)
             await update.message.reply_text(f"✅ 用户 {uid} 已封禁")
         except:
             await update.message.reply_text("格式错误，请输入数字ID")
@@ -434,7 +613,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif state == 'unbanning' and is_admin(update.effective_user.id):
         try:
             uid = int(text)
-            db.ban_user(uid, False)
+            await adb.write(db.ban_user, uid, False)
             await update.message.reply_text(f"✅ 用户 {uid} 已解封")
         except:
             await update.message.reply_text("格式错误，请输入数字ID")
@@ -458,8 +637,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(
                 "发货方式？",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🤖 自动发货", callback_data="newproduct_auto")],
-                    [InlineKeyboardButton("👤 人工发货", callback_data="newproduct_manual")],
+                    [InlineKeyboardButton("🤖 自动发货", callback_data=callbacks.encode("newproduct", "auto"))],
+                    [InlineKeyboardButton("👤 人工发货", callback_data=callbacks.encode("newproduct", "manual"))],
                 ])
             )
         except:
@@ -467,51 +646,76 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif state == 'add_cards_input' and is_admin(update.effective_user.id):
         pid = context.user_data.get('add_cards_pid')
-        lines = text.splitlines()
-        db.add_cards(pid, lines)
-        p = db.get_product(pid)
-        await update.message.reply_text(f"✅ 成功添加 {len([l for l in lines if l.strip()])} 条卡密，当前库存：{p['stock_count']}")
+        inserted, duplicates = await adb.write(db.add_cards, pid, text.splitlines())
+        p = await catalog.get_product(pid)
+        await update.message.reply_text(f"✅ 成功添加 {inserted} 条卡密，重复跳过 {duplicates} 条，当前库存：{p['stock_count']}")
         context.user_data['state'] = None
 
     elif state == 'set_price_input' and is_admin(update.effective_user.id):
         pid = context.user_data.get('set_price_pid')
         try:
             price = float(text)
-            db.update_product_price(pid, price)
+            await adb.write(db.update_product_price, pid, price)
             await update.message.reply_text(f"✅ 商品 #{pid} 价格已更新为 {price} USDT")
         except:
             await update.message.reply_text("价格格式错误")
         context.user_data['state'] = None
 
     elif state == 'broadcasting' and is_admin(update.effective_user.id):
-        users = db.get_all_users()
-        success, fail = 0, 0
-        for u in users:
-            try:
-                await context.bot.send_message(u['user_id'], f"📢 *公告*\n\n{text}", parse_mode="Markdown")
-                success += 1
-            except:
-                fail += 1
-        await update.message.reply_text(f"📢 广播完成：成功 {success}，失败 {fail}")
+        # 后台发送，进度在状态消息中实时更新
+        await broadcast.start(context.bot, update.effective_chat.id, text)
         context.user_data['state'] = None
 
     else:
         await update.message.reply_text("请使用 /start 开始", reply_markup=main_menu_keyboard())
 
 # ============================================================
-# 处理添加商品类型选择
+# 卡密文件导入
 # ============================================================
-async def handle_new_product_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    if not is_admin(query.from_user.id):
+def iter_card_chunks(path, size):
+    """逐行读取卡密文件，每 size 行产出一块，不把整个文件读入内存"""
+    chunk = []
+    with open(path, encoding="utf-8-sig", errors="replace") as f:
+        for line in f:
+            chunk.append(line)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """管理员在「添加卡密」状态下上传 .txt / .csv 文件，每行一条卡密，分块批量导入"""
+    if context.user_data.get('state') != 'add_cards_input' or not is_admin(update.effective_user.id):
         return
+    doc = update.message.document
+    if not (doc.file_name or "").lower().endswith((".txt", ".csv")):
+        await update.message.reply_text("仅支持 .txt / .csv 文件，每行一条卡密")
+        return
+    pid = context.user_data.get('add_cards_pid')
+    await update.message.reply_text("⏳ 正在导入卡密...")
+    inserted, duplicates = 0, 0
+    tg_file = await doc.get_file()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = await tg_file.download_to_drive(os.path.join(tmp, "cards.txt"))
+        for chunk in iter_card_chunks(path, config.CARD_IMPORT_CHUNK):
+            added, dup = await adb.write(db.insert_cards, pid, chunk)
+            inserted += added
+            duplicates += dup
+    p = await catalog.get_product(pid)
+    await update.message.reply_text(f"✅ 导入完成：新增 {inserted} 条，重复跳过 {duplicates} 条，当前库存：{p['stock_count']}")
+    context.user_data['state'] = None
+
+# ============================================================
+# 处理添加商品类型选择
+# ============================================================
+@callbacks.route("newproduct", admin=True)
+async def handle_new_product_type(query, context, kind):
     np = context.user_data.get('new_product', {})
-    auto = 1 if data == "newproduct_auto" else 0
-    pid = db.add_product(np.get('name',''), np.get('desc',''), np.get('price', 0), auto)
+    auto = 1 if kind == "auto" else 0
+    pid = await adb.write(db.add_product, np.get('name',''), np.get('desc',''), np.get('price', 0), auto)
     await query.edit_message_text(
-        f"✅ 商品添加成功！\n\n#{pid} {np.get('name')} - {np.get('price')} USDT\n{product_type_label(auto)}\n\n"
+        f"✅ 商品添加成功！\n\n#{pid} {np.get('name')} - {np.get('price')} USDT\n{catalog.product_type_label(auto)}\n\n"
         + ("自动发货请用 /admin → 添加卡密 添加库存" if auto else "")
     )
     context.user_data['state'] = None
@@ -520,22 +724,109 @@ async def handle_new_product_type(update: Update, context: ContextTypes.DEFAULT_
 # ============================================================
 # 启动
 # ============================================================
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    不同用户的更新并发处理，同一用户的更新按到达顺序串行处理，
+    保证 handle_message 的 user_data['state'] 状态机不会乱序
+
+    PTB 的 process_update（@final）先占基类信号量再调用 do_process_update，
+    若用基类信号量限流，排队等用户锁的更新也会占住名额，单个用户连发即可占满；
+    因此基类信号量设为不限，并发上限由这里自己的信号量在拿到用户锁之后再控制
+    """
+    # 传给基类的并发数（即不限）；Application 只在其大于 1 时为每个更新创建任务
+    _UNLIMITED = 2 ** 31 - 1
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(self._UNLIMITED)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # {user_id: [锁, 排队数]}，排队数归零即删除，不随用户总数增长
+        self._user_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def webhook_secret():
+    """Webhook 校验令牌：未配置 WEBHOOK_SECRET 时由 BOT_TOKEN 派生，重启后保持不变"""
+    return config.WEBHOOK_SECRET or hashlib.sha256(config.BOT_TOKEN.encode()).hexdigest()
+
+async def on_startup(app):
+    await broadcast.resume(app.bot)
+
+async def on_stop(app):
+    """更新接收已停止、Bot 仍可发消息：发出积压的通知摘要，等待后台任务收尾"""
+    await notify.flush_digest(app)
+    await tasks.drain(config.SHUTDOWN_DRAIN_TIMEOUT)
+
+async def on_shutdown(app):
+    await tron_payment.close_async_client()
+    await flush_users()
+    adb.shutdown()
+    db.close_all()
+
 def main():
     db.init_db()
-    app = Application.builder().token(config.BOT_TOKEN).build()
+    db.load_banned_ids()
+    restore_pending_orders()
+    app = (Application.builder().token(config.BOT_TOKEN)
+           .concurrent_updates(PerUserUpdateProcessor(config.UPDATE_CONCURRENCY))
+           .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown).build())
+    app.job_queue.run_repeating(scan_payments, interval=config.PAYMENT_SCAN_INTERVAL,
+                                first=config.PAYMENT_SCAN_INTERVAL)
+    app.job_queue.run_repeating(flush_users, interval=config.USER_FLUSH_INTERVAL,
+                                first=config.USER_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(notify.flush_digest, interval=config.NOTIFY_DIGEST_INTERVAL,
+                                first=config.NOTIFY_DIGEST_INTERVAL)
+    app.job_queue.run_repeating(sync_banned_ids, interval=config.BAN_SYNC_INTERVAL,
+                                first=config.BAN_SYNC_INTERVAL)
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", admin_cmd))
+    app.add_handler(CommandHandler("repair_stock", repair_stock_cmd))
+    app.add_handler(CommandHandler("status", status_cmd))
 
-    # 新商品类型选择
-    app.add_handler(CallbackQueryHandler(handle_new_product_type, pattern="^newproduct_"))
-    # 所有其他按钮
-    app.add_handler(CallbackQueryHandler(callback_router))
+    # 所有按钮
+    app.add_handler(CallbackQueryHandler(callbacks.dispatch))
     # 文字消息
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # 卡密文件上传
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
 
     logger.info("机器人启动中...")
-    app.run_polling(drop_pending_updates=True)
+    if config.WEBHOOK_URL:
+        logger.info(f"Webhook 模式：监听 {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}/{config.WEBHOOK_PATH}")
+        app.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=config.WEBHOOK_URL,
+            secret_token=webhook_secret(),
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=True,
+        )
+    else:
+        app.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()
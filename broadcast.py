@@ -0,0 +1,135 @@
+"""
+后台广播引擎
+广播任务在后台运行，不占用管理员的消息处理；收件人按 user_id 游标分页读取，
+并发发送并遵守 Telegram 全局 / 单聊限速，遇到 RetryAfter 全局暂停；
+每页发送完保存进度，重启后从上次的游标继续，状态消息实时显示成功 / 失败数
+"""
+import asyncio
+import logging
+import time
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+import config
+import database as db
+import async_db as adb
+import tasks
+
+logger = logging.getLogger(__name__)
+
+# 正在运行的广播 {broadcast_id: task}
+running = {}
+
+# 全局发送节奏：下一个可用发送时间点；RetryAfter 时整体暂停到 _paused_until
+_next_slot = 0.0
+_paused_until = 0.0
+# 单聊最近发送时间 {chat_id: monotonic}，_acquire 中按间隔清理
+_chat_last_sent = {}
+_last_prune = 0.0
+# 清理间隔（秒）
+_PRUNE_INTERVAL = 60
+
+async def _acquire(chat_id):
+    """等待全局与单聊限速放行"""
+    global _next_slot
+    while True:
+        now = time.monotonic()
+        wait = max(_paused_until - now, _chat_last_sent.get(chat_id, 0) + config.BROADCAST_CHAT_INTERVAL - now)
+        if wait <= 0:
+            break
+        await asyncio.sleep(wait)
+    slot = max(now, _next_slot)
+    _next_slot = slot + 1 / config.BROADCAST_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+    now = time.monotonic()
+    _chat_last_sent[chat_id] = now
+    if now - _last_prune >= _PRUNE_INTERVAL:
+        _prune_chat_times(now)
+
+def _prune_chat_times(now):
+    """删除已过单聊间隔的记录（广播、超时通知等所有限速发送共用），内存只与近期收件人数有关"""
+    global _last_prune
+    _last_prune = now
+    deadline = now - config.BROADCAST_CHAT_INTERVAL
+    for chat_id in [c for c, t in _chat_last_sent.items() if t < deadline]:
+        del _chat_last_sent[chat_id]
+
+async def send_limited(bot, chat_id, text, **kwargs):
+    """限速发送一条消息，遇到 RetryAfter 全局暂停后重试；返回是否发送成功"""
+    global _paused_until
+    for _ in range(config.BROADCAST_MAX_RETRIES):
+        await _acquire(chat_id)
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+            return True
+        except RetryAfter as e:
+            _paused_until = max(_paused_until, time.monotonic() + e.retry_after)
+            logger.warning(f"触发 Telegram 限速，暂停发送 {e.retry_after} 秒")
+        except (Forbidden, BadRequest):
+            # 用户已拉黑机器人 / 聊天不存在，重试无意义
+            return False
+        except TelegramError as e:
+            logger.warning(f"发送给 {chat_id} 失败: {e}")
+    return False
+
+def _progress_text(b, success, fail, done=False):
+    head = f"📢 广播 #{b['id']} 已完成" if done else f"📢 广播 #{b['id']} 发送中..."
+    return f"{head}\n✅ 成功：{success}\n❌ 失败：{fail}"
+
+async def _update_status(bot, b, text):
+    if not b['status_message_id']:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=b['admin_chat_id'], message_id=b['status_message_id'])
+    except TelegramError:
+        pass
+
+async def _run(bot, bid):
+    b = await adb.read(db.get_broadcast, bid)
+    cursor, success, fail = b['cursor'], b['success'], b['fail']
+    text = f"📢 *公告*\n\n{b['text']}"
+    sem = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+    last_report = time.monotonic()
+
+    async def send_one(chat_id):
+        async with sem:
+            return await send_limited(bot, chat_id, text, parse_mode="Markdown")
+
+    while True:
+        user_ids = await adb.read(db.get_user_ids_after, cursor, config.BROADCAST_PAGE_SIZE)
+        if not user_ids:
+            break
+        results = await asyncio.gather(*[send_one(uid) for uid in user_ids])
+        sent = sum(results)
+        success += sent
+        fail += len(results) - sent
+        cursor = user_ids[-1]
+        # 每页保存一次进度：重启后最多重发一页
+        await adb.write(db.save_broadcast_progress, bid, cursor, success, fail)
+        if time.monotonic() - last_report >= config.BROADCAST_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await _update_status(bot, b, _progress_text(b, success, fail))
+
+    await adb.write(db.finish_broadcast, bid)
+    await _update_status(bot, b, _progress_text(b, success, fail, done=True))
+    logger.info(f"广播 #{bid} 完成：成功 {success}，失败 {fail}")
+
+def _spawn(bot, bid):
+    # 进度已按页保存，停机时直接取消，重启后继续
+    task = tasks.spawn(_run(bot, bid), f"broadcast-{bid}", cancel_on_shutdown=True)
+    running[bid] = task
+    task.add_done_callback(lambda t: running.pop(bid, None))
+    return task
+
+async def start(bot, admin_chat_id, text):
+    """创建并在后台启动广播任务，返回广播 ID"""
+    bid = await adb.write(db.create_broadcast, admin_chat_id, text)
+    msg = await bot.send_message(admin_chat_id, f"📢 广播 #{bid} 已开始，进度将在此更新")
+    await adb.write(db.set_broadcast_status_message, bid, msg.message_id)
+    _spawn(bot, bid)
+    return bid
+
+async def resume(bot):
+    """启动时继续上次未完成的广播"""
+    for b in await adb.read(db.get_running_broadcasts):
+        logger.info(f"继续广播 #{b['id']}（已发送至 user_id {b['cursor']}）")
+        _spawn(bot, b['id'])
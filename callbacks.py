@@ -0,0 +1,69 @@
+"""
+按钮回调路由
+callback_data 统一编码为 "动作:参数1:参数2"（如 buy:12、toggle:3:1），
+按动作名查表分发，管理员权限和限流类别（浏览 read / 下单 write）在路由登记时声明，
+由 dispatch 统一检查一次
+
+用法：
+    @callbacks.route("buy")
+    async def handle_buy(query, context, pid): ...
+
+    InlineKeyboardButton("购买", callback_data=callbacks.encode("buy", pid))
+"""
+import config
+import ratelimit
+
+SEP = ":"
+
+# 动作名 -> (处理函数, 是否仅管理员, 限流类别)
+routes = {}
+
+def encode(action, *args):
+    """生成 callback_data，Telegram 限制 64 字节"""
+    data = SEP.join((action, *map(str, args)))
+    if len(data.encode()) > 64:
+        raise ValueError(f"callback_data 超过 64 字节: {data}")
+    return data
+
+def _parse_arg(s):
+    return int(s) if s.isdigit() else s
+
+def decode(data):
+    """解析 callback_data，返回 (动作名, 参数元组)；数字参数转为 int"""
+    action, sep, rest = data.partition(SEP)
+    if sep:
+        return action, tuple(map(_parse_arg, rest.split(SEP)))
+    if action in routes:
+        return action, ()
+    # 兼容旧格式按钮（如 do_deliver_12、toggle_3_1），已发出的消息里仍可能点到
+    parts = data.split("_")
+    i = len(parts)
+    while i > 1 and parts[i - 1].isdigit():
+        i -= 1
+    return "_".join(parts[:i]), tuple(int(p) for p in parts[i:])
+
+def route(action, admin=False, kind="read"):
+    """登记回调处理函数：handler(query, context, *参数)；创建订单等写操作登记为 kind="write" """
+    def register(handler):
+        if action in routes:
+            raise ValueError(f"回调动作重复登记: {action}")
+        routes[action] = (handler, admin, kind)
+        return handler
+    return register
+
+async def dispatch(update, context):
+    """CallbackQueryHandler 入口：解码后查表分发，未登记或无权限的回调忽略，超出限流的提示稍后再试"""
+    query = update.callback_query
+    action, args = decode(query.data)
+    entry = routes.get(action)
+    if entry is None:
+        await query.answer()
+        return
+    handler, admin, kind = entry
+    if not ratelimit.allow(query.from_user.id, kind):
+        await query.answer("操作太频繁，请稍后再试")
+        return
+    await query.answer()
+    if admin and query.from_user.id not in config.ADMIN_IDS:
+        return
+    await handler(query, context, *args)
@@ -0,0 +1,84 @@
+"""
+商品目录缓存
+缓存商品行、渲染好的文字和按钮，商品目录一天只变几次，浏览无需访问数据库
+database.py 中每次目录写操作提交后递增 catalog_version，版本不一致时整体重建
+"""
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import callbacks
+import database as db
+import async_db as adb
+
+_snapshot = None
+
+def product_type_label(auto):
+    return "🤖 自动发货" if auto else "👤 人工发货"
+
+def _render_shop(enabled):
+    if not enabled:
+        return None
+    keyboard = []
+    for p in enabled:
+        stock_info = f" (库存:{p['stock_count']})" if p['auto_delivery'] else ""
+        label = f"{'🤖' if p['auto_delivery'] else '👤'} {p['name']} - {p['price']} USDT{stock_info}"
+        keyboard.append([InlineKeyboardButton(label, callback_data=callbacks.encode("product", p['id']))])
+    keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
+    return "🛍 *请选择商品：*", InlineKeyboardMarkup(keyboard)
+
+def _render_detail(p):
+    stock_text = f"\n📦 库存：{p['stock_count']} 件" if p['auto_delivery'] else ""
+    text = (f"*{p['name']}*\n\n"
+            f"📝 {p['description'] or '暂无描述'}\n"
+            f"💰 价格：{p['price']} USDT\n"
+            f"🚀 {product_type_label(p['auto_delivery'])}{stock_text}")
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🛒 立即购买", callback_data=callbacks.encode("buy", p['id']))],
+        [InlineKeyboardButton("🔙 返回商品列表", callback_data="shop")]
+    ])
+    return text, keyboard
+
+def _render_admin_products(products):
+    if not products:
+        return "暂无商品"
+    lines = ["📦 *商品列表：*\n"]
+    for p in products:
+        status = "✅" if p['enabled'] else "🔴"
+        lines.append(f"{status} #{p['id']} {p['name']} - {p['price']}U | {product_type_label(p['auto_delivery'])} | 库存:{p['stock_count']}")
+    return "\n".join(lines)
+
+def _build(version, products):
+    enabled = [p for p in products if p['enabled']]
+    auto_products = [p for p in products if p['auto_delivery']]
+    return {
+        "version": version,
+        "products": {p['id']: p for p in products},
+        "shop": _render_shop(enabled),
+        "details": {p['id']: _render_detail(p) for p in products},
+        "admin_products": _render_admin_products(products),
+        "set_price": InlineKeyboardMarkup(
+            [[InlineKeyboardButton(f"#{p['id']} {p['name']}", callback_data=callbacks.encode("setprice", p['id']))] for p in products]),
+        "toggle": InlineKeyboardMarkup([[InlineKeyboardButton(
+            f"{'✅' if p['enabled'] else '🔴'} #{p['id']} {p['name']}",
+            callback_data=callbacks.encode("toggle", p['id'], 0 if p['enabled'] else 1)
+        )] for p in products]),
+        "delete": InlineKeyboardMarkup(
+            [[InlineKeyboardButton(f"🗑 #{p['id']} {p['name']}", callback_data=callbacks.encode("delproduct", p['id']))] for p in products]),
+        "cards": InlineKeyboardMarkup(
+            [[InlineKeyboardButton(f"#{p['id']} {p['name']} (库存:{p['stock_count']})", callback_data=callbacks.encode("addcards", p['id']))]
+             for p in auto_products]) if auto_products else None,
+    }
+
+async def snapshot():
+    """
+    返回当前目录快照；版本未变时直接返回缓存，不访问数据库
+    先读版本号再读数据：读取期间若有新提交，版本号已变，下次访问会再次重建
+    """
+    global _snapshot
+    version = db.catalog_version
+    if _snapshot is None or _snapshot["version"] != version:
+        products = await adb.read(db.get_products, enabled_only=False)
+        _snapshot = _build(version, products)
+    return _snapshot
+
+async def get_product(pid):
+    """按 ID 取商品行（含已下架商品），不存在返回 None"""
+    return (await snapshot())["products"].get(pid)
@@ -19,20 +19,88 @@ USDT_WALLET = "在这里填写你的TRC20钱包地址"
 # 订单支付等待超时时间（分钟）
 PAYMENT_TIMEOUT = 30
 
-# 金额误差容忍（单位 USDT）
-AMOUNT_TOLERANCE = 0.02
+# 每个用户最多同时存在的待支付订单数（同一商品重复点击购买会复用原订单）
+MAX_PENDING_ORDERS_PER_USER = 3
+
+# 支付扫描间隔（秒），每轮只请求一次 TronGrid
+PAYMENT_SCAN_INTERVAL = 30
+
+# 应付金额尾数：同价订单依次加 AMOUNT_STEP USDT 以区分（最多 AMOUNT_SLOTS 个并发待支付订单）
+AMOUNT_STEP = 0.001
+AMOUNT_SLOTS = 100
+
+# TronGrid 请求超时（秒）与最大并发连接数
+TRONGRID_TIMEOUT = 10
+TRONGRID_MAX_CONCURRENCY = 4
+# 每轮扫描最多翻页数（每页 200 条）
+TRONGRID_MAX_PAGES = 5
 
 # TronGrid API Key（免费注册：https://www.trongrid.io/）
 # 可留空，留空则使用公共接口（有限速）
 TRONGRID_API_KEY = ""
 
+# ========================================
+# Webhook（可选）
+# ========================================
+
+# 留空使用长轮询；填写公网 HTTPS 地址（如 https://shop.example.com/telegram）则启用 Webhook，
+# 由反向代理转发到 WEBHOOK_LISTEN:WEBHOOK_PORT 的 /WEBHOOK_PATH
+WEBHOOK_URL = ""
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+# 校验请求头 X-Telegram-Bot-Api-Secret-Token，留空则由 BOT_TOKEN 派生
+WEBHOOK_SECRET = ""
+# Telegram 同时向 Webhook 发起的最大连接数（1-100）
+WEBHOOK_MAX_CONNECTIONS = 40
+
 # ========================================
 # 其他配置
 # ========================================
 
+# 同时处理的更新数上限：不同用户并发处理，同一用户的更新按顺序处理
+UPDATE_CONCURRENCY = 64
+
+# 防刷限流（令牌桶）：(每秒补充令牌数, 桶容量)，管理员不受限
+# read：浏览类按钮和文字消息；write：下单。每类同时受单用户桶和全局桶限制
+RATE_LIMITS = {
+    "read": {"user": (2, 10), "global": (200, 400)},
+    "write": {"user": (0.2, 3), "global": (20, 50)},
+}
+
+# 停机时等待后台通知发送完成的最长时间（秒），超时未发完的取消
+SHUTDOWN_DRAIN_TIMEOUT = 10
+
 # 数据库文件路径
 DATABASE = "shop.db"
 
+# 数据库读线程数；写操作由单独写线程在 DB_GROUP_COMMIT_MS 毫秒窗口内合并提交（每批最多 DB_GROUP_COMMIT_MAX 条）
+DB_READ_THREADS = 4
+DB_GROUP_COMMIT_MS = 5
+DB_GROUP_COMMIT_MAX = 200
+
+# 卡密文件导入：每批写入行数
+CARD_IMPORT_CHUNK = 5000
+
+# 用户资料批量写入间隔（秒），/start 只在资料变化时写库
+USER_FLUSH_INTERVAL = 2
+
+# 封禁名单与数据库核对间隔（秒），用于发现其他进程直接修改数据库
+BAN_SYNC_INTERVAL = 60
+
+# 广播：每秒最多发送条数（Telegram 全局上限约 30，留出余量给正常交互）、同一聊天最小间隔（秒）、
+# 并发数、每页用户数（每页保存一次进度）、进度消息刷新间隔（秒）、单条最多重试次数
+BROADCAST_RATE = 25
+BROADCAST_CHAT_INTERVAL = 1
+BROADCAST_CONCURRENCY = 20
+BROADCAST_PAGE_SIZE = 100
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_MAX_RETRIES = 3
+
+# 管理员通知：同类通知在 NOTIFY_DIGEST_INTERVAL 秒内超过 NOTIFY_BURST_LIMIT 条后，合并为定时摘要
+NOTIFY_BURST_LIMIT = 5
+NOTIFY_DIGEST_INTERVAL = 60
+
 # 人工发货时显示的客服账号
 CUSTOMER_SERVICE = "@你的客服TG用户名"
 
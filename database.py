@@ -1,12 +1,122 @@
+import hashlib
 import sqlite3
+import threading
 import config
 
-def get_conn():
-    conn = sqlite3.connect(config.DATABASE)
+# 每个线程复用一个长连接，避免每次查询都重新打开数据库
+_local = threading.local()
+_all_conns = []
+_all_conns_lock = threading.Lock()
+
+# 连接参数：WAL 允许读写并发，NORMAL 在 WAL 下只在检查点 fsync
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA mmap_size=268435456",   # 256MB
+    "PRAGMA cache_size=-65536",     # 64MB
+    "PRAGMA temp_store=MEMORY",
+)
+
+def _connect():
+    conn = sqlite3.connect(config.DATABASE, timeout=5, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    with _all_conns_lock:
+        _all_conns.append(conn)
+    return conn
+
+def get_conn():
+    """
+    返回当前线程的长连接（首次调用时创建并设置 PRAGMA）
+    连接由模块统一管理，调用方无需关闭
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    elif conn.in_transaction and not in_batch():
+        # 上一次调用异常中断留下的未提交事务
+        conn.rollback()
+    return conn
+
+# ===== 批量提交（group commit） =====
+# 写线程把多次写操作放进同一个事务：每个操作包在 SAVEPOINT 中，
+# 操作内部的提交 / 回滚只作用于自己的 SAVEPOINT，最后由批次统一 COMMIT
+BATCH_SAVEPOINT = "batch_op"
+
+def in_batch():
+    return getattr(_local, "batching", False)
+
+def begin_batch():
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    _local.batching = True
     return conn
 
+def end_batch():
+    """批次提交（或回滚）之后调用"""
+    _local.batching = False
+    if getattr(_local, "catalog_dirty", False):
+        _local.catalog_dirty = False
+        _bump_catalog_version()
+
+def _begin_immediate(conn):
+    if not in_batch():
+        conn.execute("BEGIN IMMEDIATE")
+
+def _commit(conn):
+    if not in_batch():
+        conn.commit()
+
+# ===== 商品目录版本 =====
+# 商品、价格、上下架、库存等目录数据每次提交变更后递增，缓存发现版本变化即重建
+catalog_version = 0
+_catalog_lock = threading.Lock()
+
+def _bump_catalog_version():
+    global catalog_version
+    with _catalog_lock:
+        catalog_version += 1
+
+def _touch_catalog():
+    """目录写操作提交后调用；批量提交中推迟到整批提交后再递增版本"""
+    if in_batch():
+        _local.catalog_dirty = True
+    else:
+        _bump_catalog_version()
+
+def _rollback(conn):
+    if in_batch():
+        conn.execute(f"ROLLBACK TO {BATCH_SAVEPOINT}")
+    else:
+        conn.rollback()
+
+def close_all():
+    """关闭所有线程的连接（程序退出时调用）"""
+    with _all_conns_lock:
+        for conn in _all_conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _all_conns.clear()
+    _local.__dict__.clear()
+
+# claim_card / expire_pending_orders 使用 UPDATE ... RETURNING，需 SQLite 3.35+
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+def check_sqlite_version():
+    """SQLite 版本过低时直接报错，避免启动或升级迁移执行到一半才出现语法错误"""
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        need = ".".join(map(str, MIN_SQLITE_VERSION))
+        raise RuntimeError(
+            f"SQLite 版本 {sqlite3.sqlite_version} 过低，需要 {need} 或更高版本"
+            f"（Ubuntu 22.04+ / Debian 12+ 系统自带的 Python 即满足要求）"
+        )
+
 def init_db():
+    check_sqlite_version()
     conn = get_conn()
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS products (
@@ -49,8 +159,185 @@ def init_db():
         banned INTEGER DEFAULT 0,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS transfers (
+        tx_id TEXT PRIMARY KEY,
+        from_address TEXT,
+        amount_micro INTEGER NOT NULL,
+        block_timestamp INTEGER NOT NULL,
+        order_id INTEGER UNIQUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transfers_unconsumed ON transfers(block_timestamp) WHERE order_id IS NULL")
+    c.execute('''CREATE TABLE IF NOT EXISTS scan_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )''')
     conn.commit()
-    conn.close()
+    migrate(conn)
+
+# ===== 数据库迁移 =====
+def _backfill_card_hashes(conn):
+    """为已有卡密补算哈希；同一商品下重复的旧卡密保留 NULL，避免唯一索引冲突"""
+    seen = set()
+    updates = []
+    for row in conn.execute("SELECT id,product_id,content FROM cards ORDER BY id"):
+        key = (row['product_id'], card_hash(row['content']))
+        if key in seen:
+            continue
+        seen.add(key)
+        updates.append((key[1], row['id']))
+    conn.executemany("UPDATE cards SET content_hash=? WHERE id=?", updates)
+
+def _backfill_daily_stats(conn):
+    """按已有订单和用户重建历史汇总（取消时间未记录，按下单日期计入）"""
+    conn.execute("""
+        INSERT INTO daily_stats (day, product_id, orders, paid, revenue_micro, delivered, cancelled)
+        SELECT day, product_id, SUM(orders), SUM(paid), SUM(revenue_micro), SUM(delivered), SUM(cancelled) FROM (
+            SELECT date(created_at) AS day, product_id, 1 AS orders, 0 AS paid, 0 AS revenue_micro,
+                   0 AS delivered, status='cancelled' AS cancelled FROM orders
+            UNION ALL
+            SELECT date(paid_at), product_id, 0, 1, CAST(ROUND(amount * 1000000) AS INTEGER), 0, 0
+            FROM orders WHERE paid_at IS NOT NULL
+            UNION ALL
+            SELECT date(delivered_at), product_id, 0, 0, 0, 1, 0 FROM orders WHERE delivered_at IS NOT NULL
+        ) GROUP BY day, product_id
+    """)
+    conn.execute("""
+        INSERT INTO daily_stats (day, product_id, new_users)
+        SELECT date(created_at), 0, COUNT(*) FROM users GROUP BY date(created_at)
+        ON CONFLICT (day, product_id) DO UPDATE SET new_users=excluded.new_users
+    """)
+
+# (版本号, [SQL 或 callable(conn), ...])，启动时按顺序执行尚未应用的版本
+# 已发布的迁移不要修改，结构变更一律追加新版本
+MIGRATIONS = [
+    (1, [
+        # get_available_card / update_stock_count
+        "CREATE INDEX IF NOT EXISTS idx_cards_product_used ON cards(product_id, used)",
+        # get_user_orders
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)",
+        # get_pending_orders / get_paid_orders
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)",
+        # get_all_orders
+        "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)",
+    ]),
+    (2, [
+        # 卡密内容哈希，用于导入去重
+        "ALTER TABLE cards ADD COLUMN content_hash TEXT",
+        _backfill_card_hashes,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_cards_product_hash ON cards(product_id, content_hash)",
+    ]),
+    (3, [
+        # 库存计数增量维护，不再 COUNT(*) 重算：
+        # 领取 / 删除卡密由触发器逐行更新，批量导入由 insert_cards 在同一事务内按批累加
+        """CREATE TRIGGER IF NOT EXISTS trg_cards_stock_delete AFTER DELETE ON cards WHEN OLD.used=0
+           BEGIN UPDATE products SET stock_count=stock_count-1 WHERE id=OLD.product_id; END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_cards_stock_update AFTER UPDATE OF used, product_id ON cards
+           WHEN OLD.used != NEW.used OR OLD.product_id != NEW.product_id
+           BEGIN
+               UPDATE products SET stock_count=stock_count-1 WHERE id=OLD.product_id AND OLD.used=0;
+               UPDATE products SET stock_count=stock_count+1 WHERE id=NEW.product_id AND NEW.used=0;
+           END""",
+        lambda conn: _reconcile_stock_counts(conn),
+    ]),
+    (4, [
+        # 封禁名单加载 / 一致性检查
+        "CREATE INDEX IF NOT EXISTS idx_users_banned ON users(user_id) WHERE banned=1",
+    ]),
+    (5, [
+        # 后台广播任务及进度（按 user_id 游标续传）
+        '''CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER NOT NULL,
+            status_message_id INTEGER,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            cursor INTEGER DEFAULT 0,
+            success INTEGER DEFAULT 0,
+            fail INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )''',
+    ]),
+    (6, [
+        # get_user_pending_orders：下单时复用同商品的待支付订单 / 统计用户待支付订单数
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_pending ON orders(user_id, product_id) WHERE status='pending'",
+    ]),
+    (7, [
+        # 订单列表按 id 键集分页（get_orders_page 直接走主键）
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_auto_id ON orders(status, auto_delivery, id)",
+    ]),
+    (8, [
+        # 按天 / 商品的销售汇总，后台统计只读这张表，不扫描 orders
+        # product_id=0 的行记录当天新增用户数；日期为 UTC，与 created_at 一致
+        '''CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            orders INTEGER DEFAULT 0,
+            paid INTEGER DEFAULT 0,
+            revenue_micro INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            cancelled INTEGER DEFAULT 0,
+            new_users INTEGER DEFAULT 0,
+            PRIMARY KEY (day, product_id)
+        )''',
+        _backfill_daily_stats,
+        # 订单状态每次变化都在同一事务内累加，覆盖 mark_order_paid / consume_transfer / claim_card /
+        # mark_order_delivered / cancel_order / expire_pending_orders 等所有状态转换
+        """CREATE TRIGGER IF NOT EXISTS trg_orders_stats_insert AFTER INSERT ON orders
+           BEGIN
+               INSERT INTO daily_stats (day, product_id, orders) VALUES (date('now'), NEW.product_id, 1)
+               ON CONFLICT (day, product_id) DO UPDATE SET orders=orders+1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_orders_stats_status AFTER UPDATE OF status ON orders
+           WHEN OLD.status != NEW.status
+           BEGIN
+               INSERT INTO daily_stats (day, product_id, paid, revenue_micro, delivered, cancelled)
+               VALUES (date('now'), NEW.product_id,
+                       OLD.status='pending' AND NEW.status IN ('paid','delivered'),
+                       CASE WHEN OLD.status='pending' AND NEW.status IN ('paid','delivered')
+                            THEN CAST(ROUND(NEW.amount * 1000000) AS INTEGER) ELSE 0 END,
+                       NEW.status='delivered',
+                       NEW.status='cancelled')
+               ON CONFLICT (day, product_id) DO UPDATE SET
+                   paid=paid+excluded.paid,
+                   revenue_micro=revenue_micro+excluded.revenue_micro,
+                   delivered=delivered+excluded.delivered,
+                   cancelled=cancelled+excluded.cancelled;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users
+           BEGIN
+               INSERT INTO daily_stats (day, product_id, new_users) VALUES (date('now'), 0, 1)
+               ON CONFLICT (day, product_id) DO UPDATE SET new_users=new_users+1;
+           END""",
+    ]),
+    (9, [
+        # 待发货列表包含库存不足转人工的自动发货订单（status='paid'，auto_delivery 不限）
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_id ON orders(status, id)",
+        "DROP INDEX IF EXISTS idx_orders_status_auto_id",
+    ]),
+]
+
+def migrate(conn):
+    """将数据库升级到最新版本，每个版本在单独的事务中执行"""
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    for version, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute("BEGIN")
+        try:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
 # ===== 商品 =====
 def get_products(enabled_only=True):
@@ -59,72 +346,129 @@ def get_products(enabled_only=True):
         rows = conn.execute("SELECT * FROM products WHERE enabled=1 ORDER BY id").fetchall()
     else:
         rows = conn.execute("SELECT * FROM products ORDER BY id").fetchall()
-    conn.close()
     return rows
 
 def get_product(pid):
     conn = get_conn()
     row = conn.execute("SELECT * FROM products WHERE id=?", (pid,)).fetchone()
-    conn.close()
     return row
 
 def add_product(name, description, price, auto_delivery):
     conn = get_conn()
     conn.execute("INSERT INTO products (name,description,price,auto_delivery) VALUES (?,?,?,?)",
                  (name, description, price, auto_delivery))
-    conn.commit()
+    _commit(conn)
+    _touch_catalog()
     pid = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-    conn.close()
     return pid
 
 def update_product_price(pid, price):
     conn = get_conn()
     conn.execute("UPDATE products SET price=? WHERE id=?", (price, pid))
-    conn.commit()
-    conn.close()
+    _commit(conn)
+    _touch_catalog()
 
 def toggle_product(pid, enabled):
     conn = get_conn()
     conn.execute("UPDATE products SET enabled=? WHERE id=?", (enabled, pid))
-    conn.commit()
-    conn.close()
+    _commit(conn)
+    _touch_catalog()
 
 def delete_product(pid):
     conn = get_conn()
     conn.execute("DELETE FROM products WHERE id=?", (pid,))
     conn.execute("DELETE FROM cards WHERE product_id=?", (pid,))
-    conn.commit()
-    conn.close()
+    _commit(conn)
+    _touch_catalog()
+
+def _reconcile_stock_counts(conn):
+    # 相关子查询而非 UPDATE ... FROM（需 SQLite 3.33+），旧版本升级迁移时也能执行
+    cur = conn.execute('''UPDATE products SET stock_count=(
+            SELECT COUNT(*) FROM cards WHERE cards.product_id=products.id AND cards.used=0)
+        WHERE stock_count IS NOT (
+            SELECT COUNT(*) FROM cards WHERE cards.product_id=products.id AND cards.used=0)''')
+    return cur.rowcount
+
+def reconcile_stock_counts():
+    """
+    修复库存计数漂移：一次分组查询统计所有商品的未用卡密数，只改写不一致的商品
+    返回被修正的商品数
+    """
+    conn = get_conn()
+    fixed = _reconcile_stock_counts(conn)
+    _commit(conn)
+    _touch_catalog()
+    return fixed
 
 def update_stock_count(pid):
     conn = get_conn()
     count = conn.execute("SELECT COUNT(*) FROM cards WHERE product_id=? AND used=0", (pid,)).fetchone()[0]
     conn.execute("UPDATE products SET stock_count=? WHERE id=?", (count, pid))
-    conn.commit()
-    conn.close()
+    _commit(conn)
+    _touch_catalog()
 
 # ===== 卡密 =====
-def add_cards(pid, contents):
-    conn = get_conn()
+def card_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def insert_cards(pid, contents):
+    """
+    批量写入一批卡密（单次 executemany），同一商品下内容重复的卡密自动跳过
+    库存在同一事务内按实际新增数累加，返回 (新增数, 重复数)
+    """
+    rows = []
     for c in contents:
         c = c.strip()
         if c:
-            conn.execute("INSERT INTO cards (product_id,content) VALUES (?,?)", (pid, c))
-    conn.commit()
-    conn.close()
-    update_stock_count(pid)
+            rows.append((pid, c, card_hash(c)))
+    conn = get_conn()
+    inserted = conn.executemany("INSERT OR IGNORE INTO cards (product_id,content,content_hash) VALUES (?,?,?)", rows).rowcount
+    conn.execute("UPDATE products SET stock_count=stock_count+? WHERE id=?", (inserted, pid))
+    _commit(conn)
+    _touch_catalog()
+    return inserted, len(rows) - inserted
+
+def add_cards(pid, contents):
+    """添加卡密，返回 (新增数, 重复数)"""
+    return insert_cards(pid, contents)
 
 def get_available_card(pid):
     conn = get_conn()
     row = conn.execute("SELECT * FROM cards WHERE product_id=? AND used=0 LIMIT 1", (pid,)).fetchone()
-    conn.close()
     return row
 
 def mark_card_used(card_id, order_id):
     conn = get_conn()
     conn.execute("UPDATE cards SET used=1,order_id=? WHERE id=?", (order_id, card_id))
-    conn.commit()
-    conn.close()
+    _commit(conn)
+    _touch_catalog()
+
+def claim_card(pid, order_id):
+    """
+    原子领取一张卡密并完成发货（同一事务）：
+    选取未用卡密并标记已用、关联订单（库存由触发器减一）、订单标记已发货
+    并发领取不会拿到同一张卡；库存不足返回 None
+    """
+    conn = get_conn()
+    try:
+        _begin_immediate(conn)
+        card = conn.execute(
+            "UPDATE cards SET used=1,order_id=? "
+            "WHERE id=(SELECT id FROM cards WHERE product_id=? AND used=0 LIMIT 1) AND used=0 "
+            "RETURNING id,content",
+            (order_id, pid)
+        ).fetchone()
+        if card is None:
+            _rollback(conn)
+            return None
+        conn.execute("UPDATE orders SET status='delivered',delivery_content=?,delivered_at=CURRENT_TIMESTAMP WHERE id=?",
+                     (card['content'], order_id))
+        _commit(conn)
+        _touch_catalog()
+        return card
+    except Exception:
+        _rollback(conn)
+        raise
 
 # ===== 订单 =====
 def create_order(user_id, username, pid, product_name, amount, auto_delivery):
@@ -133,84 +477,316 @@ def create_order(user_id, username, pid, product_name, amount, auto_delivery):
         "INSERT INTO orders (user_id,username,product_id,product_name,amount,payment_address,auto_delivery) VALUES (?,?,?,?,?,?,?)",
         (user_id, username, pid, product_name, amount, config.USDT_WALLET, auto_delivery)
     )
-    conn.commit()
+    _commit(conn)
     oid = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-    conn.close()
     return oid
 
 def get_order(oid):
     conn = get_conn()
     row = conn.execute("SELECT * FROM orders WHERE id=?", (oid,)).fetchone()
-    conn.close()
     return row
 
 def get_user_orders(user_id, limit=10):
     conn = get_conn()
     rows = conn.execute("SELECT * FROM orders WHERE user_id=? ORDER BY created_at DESC LIMIT ?",
                         (user_id, limit)).fetchall()
-    conn.close()
+    return rows
+
+def get_user_pending_orders(user_id):
+    """用户所有待支付订单（走部分索引，只扫描该用户的 pending 订单）"""
+    conn = get_conn()
+    rows = conn.execute("SELECT * FROM orders WHERE user_id=? AND status='pending' ORDER BY id DESC",
+                        (user_id,)).fetchall()
     return rows
 
 def get_pending_orders():
     conn = get_conn()
     rows = conn.execute("SELECT * FROM orders WHERE status='pending' ORDER BY created_at ASC").fetchall()
-    conn.close()
     return rows
 
 def get_paid_orders():
     conn = get_conn()
-    rows = conn.execute("SELECT * FROM orders WHERE status='paid' AND auto_delivery=0 ORDER BY created_at DESC").fetchall()
-    conn.close()
+    rows = conn.execute("SELECT * FROM orders WHERE status='paid' ORDER BY created_at DESC").fetchall()
     return rows
 
 def get_all_orders(limit=20):
     conn = get_conn()
     rows = conn.execute("SELECT * FROM orders ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
-    conn.close()
     return rows
 
+def _orders_page(where, params, limit, before_id=None, after_id=None):
+    """
+    按 id 倒序的键集分页：before_id 取更早的一页，after_id 取更新的一页，都不传取最新一页
+    每页只读 limit+1 行，翻到多深都一样快；返回 (rows, 是否有更新的页, 是否有更早的页)
+    """
+    conn = get_conn()
+    if after_id is not None:
+        rows = conn.execute(f"SELECT * FROM orders WHERE {where} AND id>? ORDER BY id ASC LIMIT ?",
+                            (*params, after_id, limit + 1)).fetchall()
+        return rows[:limit][::-1], len(rows) > limit, True
+    if before_id is not None:
+        where, params = f"{where} AND id<?", (*params, before_id)
+    rows = conn.execute(f"SELECT * FROM orders WHERE {where} ORDER BY id DESC LIMIT ?",
+                        (*params, limit + 1)).fetchall()
+    return rows[:limit], before_id is not None, len(rows) > limit
+
+def get_user_orders_page(user_id, limit, before_id=None, after_id=None):
+    return _orders_page("user_id=?", (user_id,), limit, before_id, after_id)
+
+def get_orders_page(limit, before_id=None, after_id=None):
+    return _orders_page("1", (), limit, before_id, after_id)
+
+def get_paid_orders_page(limit, before_id=None, after_id=None):
+    """待人工发货订单：人工发货商品，以及付款后库存不足转人工的自动发货商品"""
+    return _orders_page("status='paid'", (), limit, before_id, after_id)
+
 def mark_order_paid(oid):
     conn = get_conn()
     conn.execute("UPDATE orders SET status='paid',paid_at=CURRENT_TIMESTAMP WHERE id=?", (oid,))
-    conn.commit()
-    conn.close()
+    _commit(conn)
 
 def mark_order_delivered(oid, content):
     conn = get_conn()
     conn.execute("UPDATE orders SET status='delivered',delivery_content=?,delivered_at=CURRENT_TIMESTAMP WHERE id=?",
                  (content, oid))
-    conn.commit()
-    conn.close()
+    _commit(conn)
 
 def cancel_order(oid):
+    """取消待支付订单；订单已不是 pending（如扫描刚确认到账）时不修改，返回是否取消成功"""
     conn = get_conn()
-    conn.execute("UPDATE orders SET status='cancelled' WHERE id=?", (oid,))
-    conn.commit()
-    conn.close()
+    cur = conn.execute("UPDATE orders SET status='cancelled' WHERE id=? AND status='pending'", (oid,))
+    _commit(conn)
+    return cur.rowcount > 0
+
+def expire_pending_orders(cutoff):
+    """
+    一条语句取消 created_at 早于 cutoff（UTC，"%Y-%m-%d %H:%M:%S"）的全部待支付订单，
+    返回被取消的 [(id, user_id)]
+    """
+    conn = get_conn()
+    rows = conn.execute(
+        "UPDATE orders SET status='cancelled' WHERE status='pending' AND created_at < ? RETURNING id, user_id",
+        (cutoff,)
+    ).fetchall()
+    _commit(conn)
+    return rows
+
+# ===== 统计 =====
+def get_stats():
+    """后台概览：累计数据来自 daily_stats（行数与天数 × 商品数成正比），当前待处理数走状态索引"""
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT COALESCE(SUM(new_users),0), COALESCE(SUM(orders),0), COALESCE(SUM(paid),0), "
+        "COALESCE(SUM(revenue_micro),0), COALESCE(SUM(delivered),0), COALESCE(SUM(cancelled),0) FROM daily_stats"
+    ).fetchone()
+    pending = conn.execute("SELECT COUNT(*) FROM orders WHERE status='pending'").fetchone()[0]
+    awaiting = conn.execute("SELECT COUNT(*) FROM orders WHERE status='paid'").fetchone()[0]
+    return {
+        "total_users": row[0],
+        "total_orders": row[1],
+        "paid_orders": row[2],
+        "total_revenue": row[3] / 1_000_000,
+        "delivered_orders": row[4],
+        "cancelled_orders": row[5],
+        "pending_orders": pending,
+        "awaiting_delivery": awaiting,
+    }
+
+def get_daily_stats(days=7):
+    """最近 days 天（含今天）每天的汇总，按日期倒序"""
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT day, SUM(orders) AS orders, SUM(paid) AS paid, SUM(revenue_micro) AS revenue_micro, "
+        "SUM(new_users) AS new_users FROM daily_stats WHERE day >= date('now', ?) GROUP BY day ORDER BY day DESC",
+        (f"-{days - 1} days",)
+    ).fetchall()
+    return rows
+
+def get_product_stats(days=30):
+    """最近 days 天各商品的销量和收入，按收入倒序；已删除的商品 name 为 None"""
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT s.product_id, p.name, SUM(s.paid) AS paid, SUM(s.revenue_micro) AS revenue_micro "
+        "FROM daily_stats s LEFT JOIN products p ON p.id=s.product_id "
+        "WHERE s.product_id != 0 AND s.day >= date('now', ?) "
+        "GROUP BY s.product_id HAVING SUM(s.paid) > 0 ORDER BY revenue_micro DESC",
+        (f"-{days - 1} days",)
+    ).fetchall()
+    return rows
+
+# ===== 链上转账 =====
+def get_scan_cursor():
+    """返回 (block_timestamp 毫秒, TronGrid fingerprint)，未扫描过时为 (None, None)"""
+    conn = get_conn()
+    rows = dict(conn.execute("SELECT key,value FROM scan_state WHERE key IN ('cursor_ts','fingerprint')").fetchall())
+    cursor_ts = rows.get('cursor_ts')
+    return (int(cursor_ts) if cursor_ts else None), (rows.get('fingerprint') or None)
+
+def save_transfers(transfers, cursor_ts, fingerprint):
+    """
+    批量写入一页转账并推进扫描游标（同一事务）
+    transfers: [(tx_id, from_address, amount_micro, block_timestamp), ...]，已存在的 tx_id 自动跳过
+    """
+    conn = get_conn()
+    conn.executemany(
+        "INSERT OR IGNORE INTO transfers (tx_id,from_address,amount_micro,block_timestamp) VALUES (?,?,?,?)",
+        transfers
+    )
+    conn.executemany("INSERT OR REPLACE INTO scan_state (key,value) VALUES (?,?)",
+                     [('cursor_ts', str(cursor_ts)), ('fingerprint', fingerprint or '')])
+    _commit(conn)
+
+def get_unconsumed_transfers(since_ts):
+    """未被任何订单使用、且区块时间不早于 since_ts（毫秒）的转账"""
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT * FROM transfers WHERE order_id IS NULL AND block_timestamp>=? ORDER BY block_timestamp",
+        (since_ts,)
+    ).fetchall()
+    return rows
+
+def consume_transfer(tx_id, order_id):
+    """
+    将转账绑定到订单并标记订单已付款（同一事务）
+    转账已被其他订单使用或订单已不是待支付状态时不做修改，返回 False
+    """
+    conn = get_conn()
+    try:
+        cur = conn.execute("UPDATE transfers SET order_id=? WHERE tx_id=? AND order_id IS NULL", (order_id, tx_id))
+        if cur.rowcount == 0:
+            _rollback(conn)
+            return False
+        cur = conn.execute("UPDATE orders SET status='paid',paid_at=CURRENT_TIMESTAMP WHERE id=? AND status='pending'",
+                           (order_id,))
+        if cur.rowcount == 0:
+            _rollback(conn)
+            return False
+        _commit(conn)
+        return True
+    except sqlite3.IntegrityError:
+        # 订单已绑定过其他转账
+        _rollback(conn)
+        return False
 
 # ===== 用户 =====
+# 用户资料写入缓冲：/start 只记录到内存，资料有变化的用户由 flush_users 定时批量写入
+_user_profiles = {}   # 已写入数据库的资料 {user_id: (username, first_name)}
+_pending_users = {}   # 待写入的资料
+_users_lock = threading.Lock()
+
+def touch_user(user_id, username, first_name):
+    """记录一次用户访问；资料与上次写入相同则什么也不做"""
+    profile = (username, first_name)
+    with _users_lock:
+        if _user_profiles.get(user_id) != profile:
+            _pending_users[user_id] = profile
+
+def upsert_users(rows):
+    """
+    批量写入用户资料 [(user_id, username, first_name), ...]
+    新用户插入；老用户只在资料变化时更新，不影响 banned / created_at
+    """
+    conn = get_conn()
+    conn.executemany(
+        "INSERT INTO users (user_id,username,first_name) VALUES (?,?,?) "
+        "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username,first_name=excluded.first_name "
+        "WHERE users.username IS NOT excluded.username OR users.first_name IS NOT excluded.first_name",
+        rows
+    )
+    _commit(conn)
+
 def upsert_user(user_id, username, first_name):
+    upsert_users([(user_id, username, first_name)])
+
+def take_pending_users():
+    """取出并清空待写入的用户资料"""
+    global _pending_users
+    with _users_lock:
+        pending, _pending_users = _pending_users, {}
+    return [(uid, username, first_name) for uid, (username, first_name) in pending.items()]
+
+def mark_users_written(rows):
+    with _users_lock:
+        for uid, username, first_name in rows:
+            _user_profiles[uid] = (username, first_name)
+
+def requeue_users(rows):
+    """写入失败时放回缓冲（不覆盖期间新记录的资料）"""
+    with _users_lock:
+        for uid, username, first_name in rows:
+            _pending_users.setdefault(uid, (username, first_name))
+
+# 封禁用户 ID 集合：启动时加载，ban_user 同步更新，is_banned 无需查询数据库
+_banned_ids = set()
+# 保护名单的重新加载与 ban_user 的修改，避免重新加载覆盖掉并发的封禁 / 解封
+_banned_lock = threading.Lock()
+
+def load_banned_ids():
+    """
+    从数据库重新加载封禁名单，返回 (新增, 移除) 的用户 ID，用于发现其他进程对数据库的修改
+    运行中须经 async_db.write 调用：与 ban_user 同在写线程串行执行，
+    同一批次内尚未提交的封禁也能被 SELECT 读到
+    """
+    global _banned_ids
     conn = get_conn()
-    conn.execute("INSERT OR REPLACE INTO users (user_id,username,first_name) VALUES (?,?,?)",
-                 (user_id, username, first_name))
-    conn.commit()
-    conn.close()
+    with _banned_lock:
+        ids = {row[0] for row in conn.execute("SELECT user_id FROM users WHERE banned=1")}
+        added, removed = ids - _banned_ids, _banned_ids - ids
+        _banned_ids = ids
+    return added, removed
 
 def is_banned(user_id):
-    conn = get_conn()
-    row = conn.execute("SELECT banned FROM users WHERE user_id=?", (user_id,)).fetchone()
-    conn.close()
-    return row and row['banned'] == 1
+    return user_id in _banned_ids
 
 def ban_user(user_id, ban=True):
     conn = get_conn()
-    conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-    conn.execute("UPDATE users SET banned=? WHERE user_id=?", (1 if ban else 0, user_id))
-    conn.commit()
-    conn.close()
+    with _banned_lock:
+        conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        conn.execute("UPDATE users SET banned=? WHERE user_id=?", (1 if ban else 0, user_id))
+        _commit(conn)
+        if ban:
+            _banned_ids.add(user_id)
+        else:
+            _banned_ids.discard(user_id)
 
 def get_all_users():
     conn = get_conn()
     rows = conn.execute("SELECT * FROM users ORDER BY created_at DESC").fetchall()
-    conn.close()
     return rows
+
+def get_user_ids_after(last_user_id, limit):
+    """按 user_id 游标分页读取用户 ID（主键范围查询，翻页成本恒定）"""
+    conn = get_conn()
+    rows = conn.execute("SELECT user_id FROM users WHERE user_id>? ORDER BY user_id LIMIT ?",
+                        (last_user_id, limit)).fetchall()
+    return [r[0] for r in rows]
+
+# ===== 广播 =====
+def create_broadcast(admin_chat_id, text):
+    conn = get_conn()
+    cur = conn.execute("INSERT INTO broadcasts (admin_chat_id,text) VALUES (?,?)", (admin_chat_id, text))
+    _commit(conn)
+    return cur.lastrowid
+
+def get_broadcast(bid):
+    conn = get_conn()
+    return conn.execute("SELECT * FROM broadcasts WHERE id=?", (bid,)).fetchone()
+
+def get_running_broadcasts():
+    conn = get_conn()
+    return conn.execute("SELECT * FROM broadcasts WHERE status='running' ORDER BY id").fetchall()
+
+def set_broadcast_status_message(bid, message_id):
+    conn = get_conn()
+    conn.execute("UPDATE broadcasts SET status_message_id=? WHERE id=?", (message_id, bid))
+    _commit(conn)
+
+def save_broadcast_progress(bid, cursor, success, fail):
+    conn = get_conn()
+    conn.execute("UPDATE broadcasts SET cursor=?,success=?,fail=? WHERE id=?", (cursor, success, fail, bid))
+    _commit(conn)
+
+def finish_broadcast(bid):
+    conn = get_conn()
+    conn.execute("UPDATE broadcasts SET status='done',finished_at=CURRENT_TIMESTAMP WHERE id=?", (bid,))
+    _commit(conn)
@@ -38,7 +38,9 @@ detect_python() {
             ver=$($path --version 2>&1 | grep -oP '\d+\.\d+')
             major=$(echo $ver | cut -d. -f1)
             minor=$(echo $ver | cut -d. -f2)
-            if [ "$major" -ge 3 ] && [ "$minor" -ge 8 ] 2>/dev/null; then
+            # 还需 SQLite 3.35+（UPDATE ... RETURNING）
+            if [ "$major" -ge 3 ] && [ "$minor" -ge 8 ] 2>/dev/null && \
+               $path -c "import sqlite3, sys; sys.exit(sqlite3.sqlite_version_info < (3, 35, 0))" 2>/dev/null; then
                 echo "$path"
                 return
             fi
@@ -52,13 +54,13 @@ check_env() {
 
     PYTHON_BIN=$(detect_python)
     if [ -z "$PYTHON_BIN" ]; then
-        print_warn "未找到 Python3.8+，尝试安装..."
+        print_warn "未找到 Python3.8+（SQLite 3.35+），尝试安装..."
         apt-get update -qq 2>/dev/null || yum update -q 2>/dev/null
         apt-get install -y python3 python3-pip -qq 2>/dev/null || \
         yum install -y python3 python3-pip -q 2>/dev/null
         PYTHON_BIN=$(detect_python)
         if [ -z "$PYTHON_BIN" ]; then
-            print_err "Python 安装失败，请手动安装 Python3.8+"
+            print_err "Python 安装失败，或系统 SQLite 低于 3.35（如 Ubuntu 20.04），请升级系统或手动安装 Python3.8+（SQLite 3.35+）"
             exit 1
         fi
     fi
@@ -142,10 +144,42 @@ BOT_TOKEN = "$BOT_TOKEN"
 ADMIN_IDS = [$ADMIN_ID]
 USDT_WALLET = "$USDT_WALLET"
 PAYMENT_TIMEOUT = 30
-AMOUNT_TOLERANCE = 0.02
+MAX_PENDING_ORDERS_PER_USER = 3
+PAYMENT_SCAN_INTERVAL = 30
+AMOUNT_STEP = 0.001
+AMOUNT_SLOTS = 100
 TRONGRID_API_KEY = "$TRONGRID_API_KEY"
+TRONGRID_TIMEOUT = 10
+TRONGRID_MAX_CONCURRENCY = 4
+TRONGRID_MAX_PAGES = 5
+WEBHOOK_URL = ""
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+WEBHOOK_SECRET = ""
+WEBHOOK_MAX_CONNECTIONS = 40
+UPDATE_CONCURRENCY = 64
+RATE_LIMITS = {
+    "read": {"user": (2, 10), "global": (200, 400)},
+    "write": {"user": (0.2, 3), "global": (20, 50)},
+}
+SHUTDOWN_DRAIN_TIMEOUT = 10
 DATABASE = "shop.db"
+DB_READ_THREADS = 4
+DB_GROUP_COMMIT_MS = 5
+DB_GROUP_COMMIT_MAX = 200
+CARD_IMPORT_CHUNK = 5000
 CUSTOMER_SERVICE = "$CUSTOMER_SERVICE"
+BAN_SYNC_INTERVAL = 60
+USER_FLUSH_INTERVAL = 2
+BROADCAST_RATE = 25
+BROADCAST_CHAT_INTERVAL = 1
+BROADCAST_CONCURRENCY = 20
+BROADCAST_PAGE_SIZE = 100
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_MAX_RETRIES = 3
+NOTIFY_BURST_LIMIT = 5
+NOTIFY_DIGEST_INTERVAL = 60
 
 WELCOME_TEXT = """
 🛒 *欢迎来到本店！*
@@ -184,7 +218,7 @@ install_deps() {
     if $PYTHON_BIN -c "import telegram" 2>/dev/null; then
         print_ok "依赖安装完成"
     else
-        print_err "依赖安装失败！请手动执行：pip3 install python-telegram-bot==20.7 requests"
+        print_err "依赖安装失败！请手动执行：pip3 install \"python-telegram-bot[job-queue,webhooks]==20.7\" requests"
         exit 1
     fi
 }
@@ -332,6 +366,13 @@ main() {
     cp "$SCRIPT_DIR/bot.py" "$INSTALL_DIR/"
     cp "$SCRIPT_DIR/database.py" "$INSTALL_DIR/"
     cp "$SCRIPT_DIR/tron_payment.py" "$INSTALL_DIR/"
+    cp "$SCRIPT_DIR/async_db.py" "$INSTALL_DIR/"
+    cp "$SCRIPT_DIR/catalog.py" "$INSTALL_DIR/"
+    cp "$SCRIPT_DIR/broadcast.py" "$INSTALL_DIR/"
+    cp "$SCRIPT_DIR/notify.py" "$INSTALL_DIR/"
+    cp "$SCRIPT_DIR/callbacks.py" "$INSTALL_DIR/"
+    cp "$SCRIPT_DIR/ratelimit.py" "$INSTALL_DIR/"
+    cp "$SCRIPT_DIR/tasks.py" "$INSTALL_DIR/"
     cp "$SCRIPT_DIR/requirements.txt" "$INSTALL_DIR/"
     cp "$SCRIPT_DIR/handlers/__init__.py" "$INSTALL_DIR/handlers/"
     cp "$SCRIPT_DIR/handlers/admin_handlers.py" "$INSTALL_DIR/handlers/" 2>/dev/null || true
@@ -0,0 +1,82 @@
+"""
+通知发送
+管理员通知同时发给所有管理员，不阻塞买家发货流程；
+同一类通知在 NOTIFY_DIGEST_INTERVAL 秒内超过 NOTIFY_BURST_LIMIT 条时不再逐条发送，
+由定时任务合并成一条摘要（如“最近 60 秒内另有 37 笔自动发货”）；
+批量的用户通知（如订单超时）也在后台限速发送
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import config
+import broadcast
+import tasks
+
+logger = logging.getLogger(__name__)
+
+# 通知类型 -> 摘要标题
+KINDS = {
+    "auto": "🤖 自动发货成功",
+    "shortage": "⚠️ 库存不足，需人工处理",
+    "manual": "💰 收到付款，需人工发货",
+}
+# 需要管理员处理的类型，摘要附带待发货列表入口
+_ACTION_KINDS = ("shortage", "manual")
+# 摘要中最多列出的订单号数量
+_DIGEST_MAX_IDS = 20
+
+# 每类最近逐条发送的时间 {kind: deque[monotonic]}
+_recent = {}
+# 待合并进摘要的订单号 {kind: [order_id]}
+_digest = {}
+
+async def _fan_out(bot, text, reply_markup=None):
+    results = await asyncio.gather(*[
+        broadcast.send_limited(bot, admin_id, text, reply_markup=reply_markup)
+        for admin_id in config.ADMIN_IDS
+    ])
+    failed = [admin_id for admin_id, ok in zip(config.ADMIN_IDS, results) if not ok]
+    if failed:
+        logger.warning(f"管理员通知发送失败 {failed}: {text.splitlines()[0]}")
+
+def admins(bot, kind, order_id, text, reply_markup=None):
+    """通知所有管理员，立即返回不等待发送；突发时只记录订单号，由 flush_digest 汇总"""
+    now = time.monotonic()
+    recent = _recent.setdefault(kind, deque())
+    while recent and recent[0] <= now - config.NOTIFY_DIGEST_INTERVAL:
+        recent.popleft()
+    if len(recent) >= config.NOTIFY_BURST_LIMIT:
+        _digest.setdefault(kind, []).append(order_id)
+        return
+    recent.append(now)
+    tasks.spawn(_fan_out(bot, text, reply_markup), f"notify-{kind}-{order_id}")
+
+def _digest_text(kind, order_ids):
+    ids = " ".join(f"#{oid}" for oid in order_ids[:_DIGEST_MAX_IDS])
+    if len(order_ids) > _DIGEST_MAX_IDS:
+        ids += " ..."
+    return (f"{KINDS[kind]}\n"
+            f"最近 {config.NOTIFY_DIGEST_INTERVAL} 秒内另有 {len(order_ids)} 笔\n"
+            f"订单：{ids}")
+
+async def flush_digest(context):
+    """JobQueue 定时任务：把积压的通知合并成每类一条摘要发出"""
+    for kind in list(_digest):
+        order_ids = _digest.pop(kind)
+        markup = None
+        if kind in _ACTION_KINDS:
+            markup = InlineKeyboardMarkup([[InlineKeyboardButton("💰 查看待发货订单", callback_data="admin_pending_deliver")]])
+        tasks.spawn(_fan_out(context.bot, _digest_text(kind, order_ids), markup), f"notify-digest-{kind}")
+
+async def _send_users(bot, messages):
+    # 分组并发，每组 BROADCAST_CONCURRENCY 条，整体速率由 send_limited 控制
+    step = config.BROADCAST_CONCURRENCY
+    for i in range(0, len(messages), step):
+        await asyncio.gather(*[broadcast.send_limited(bot, chat_id, text) for chat_id, text in messages[i:i + step]])
+
+def users(bot, messages):
+    """后台限速发送用户通知 [(chat_id, text)]，立即返回"""
+    if messages:
+        tasks.spawn(_send_users(bot, messages), f"notify-users-{len(messages)}")
@@ -0,0 +1,48 @@
+"""
+防刷限流（令牌桶）
+浏览类（read）和下单类（write）操作分别计数，每类同时受单用户桶和全局桶限制；
+长时间不用、已补满的用户桶定期清理，内存只与近期活跃用户数有关
+"""
+import time
+import config
+
+# 令牌桶 {(kind, user_id 或 None): [剩余令牌, 上次更新时间]}，user_id 为 None 表示全局桶
+_buckets = {}
+_last_sweep = 0.0
+# 清理间隔（秒）
+_SWEEP_INTERVAL = 60
+
+def _tokens(key, rate, burst, now):
+    bucket = _buckets.get(key)
+    if bucket is None:
+        return burst
+    return min(burst, bucket[0] + (now - bucket[1]) * rate)
+
+def _sweep(now):
+    """删除已补满的用户桶（删掉后再访问会按满桶重建，效果相同）"""
+    global _last_sweep
+    _last_sweep = now
+    for key, (tokens, ts) in list(_buckets.items()):
+        kind, user_id = key
+        if user_id is None:
+            continue
+        rate, burst = config.RATE_LIMITS[kind]["user"]
+        if tokens + (now - ts) * rate >= burst:
+            del _buckets[key]
+
+def allow(user_id, kind):
+    """检查并消耗一个令牌：用户桶和全局桶都有令牌才放行；管理员不限流"""
+    if user_id in config.ADMIN_IDS:
+        return True
+    now = time.monotonic()
+    if now - _last_sweep >= _SWEEP_INTERVAL:
+        _sweep(now)
+    limits = config.RATE_LIMITS[kind]
+    user_key, global_key = (kind, user_id), (kind, None)
+    user_tokens = _tokens(user_key, *limits["user"], now)
+    global_tokens = _tokens(global_key, *limits["global"], now)
+    if user_tokens < 1 or global_tokens < 1:
+        return False
+    _buckets[user_key] = [user_tokens - 1, now]
+    _buckets[global_key] = [global_tokens - 1, now]
+    return True
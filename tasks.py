@@ -0,0 +1,49 @@
+"""
+后台任务管理
+通知、广播等后台任务统一由 spawn 启动：结束后自动移除，异常写入日志，
+counts() 返回运行中 / 已完成 / 失败 / 已取消数量；
+停机时 drain 取消可续传的任务（广播已按页保存进度），其余等待发送完成，超时才取消
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 运行中的任务 {task: 停机时是否直接取消}
+_running = {}
+stats = {"completed": 0, "failed": 0, "cancelled": 0}
+
+def _on_done(task):
+    _running.pop(task, None)
+    if task.cancelled():
+        stats["cancelled"] += 1
+    elif task.exception() is not None:
+        stats["failed"] += 1
+        logger.error(f"后台任务 {task.get_name()} 失败", exc_info=task.exception())
+    else:
+        stats["completed"] += 1
+
+def spawn(coro, name, cancel_on_shutdown=False):
+    """启动后台任务；cancel_on_shutdown=True 表示任务自行保存进度，停机时不必等待"""
+    task = asyncio.create_task(coro, name=name)
+    _running[task] = cancel_on_shutdown
+    task.add_done_callback(_on_done)
+    return task
+
+def counts():
+    return {"running": len(_running), **stats}
+
+async def drain(timeout):
+    """停机时调用：取消可续传的任务，其余最多等待 timeout 秒，仍未完成的取消"""
+    for task, cancel in list(_running.items()):
+        if cancel:
+            task.cancel()
+    pending = list(_running)
+    if not pending:
+        return
+    _, not_done = await asyncio.wait(pending, timeout=timeout)
+    for task in not_done:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if not_done:
+        logger.warning(f"停机时 {len(not_done)} 个后台任务未完成，已取消")
@@ -0,0 +1,75 @@
+"""
+按钮回调分发微基准：
+对比原 callback_router 的 if/elif 字符串匹配链（模拟）与 callbacks.decode + 路由表查找的每次开销，
+不含 Telegram 请求，只计路由本身
+
+用法：python tests/bench_dispatch.py [次数]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+import callbacks  # noqa: E402
+import bot  # noqa: E402,F401  登记全部路由
+
+USER_ID = 1
+
+# 原 callback_router 的分支顺序：(匹配方式, 值, 是否仅管理员)
+_OLD_CHAIN = (
+    ("eq", "back_home", False), ("eq", "start", False), ("eq", "admin_home", False),
+    ("eq", "shop", False), ("eq", "my_orders", False),
+    ("prefix", "product_", False), ("prefix", "buy_", False), ("prefix", "cancel_order_", False),
+    ("eq", "admin_products", True), ("eq", "admin_orders", True), ("eq", "admin_pending_deliver", True),
+    ("prefix", "do_deliver_", True), ("eq", "admin_ban", True), ("eq", "admin_unban", True),
+    ("eq", "admin_add_product", True), ("eq", "admin_set_price", True), ("prefix", "setprice_", True),
+    ("eq", "admin_toggle_product", True), ("prefix", "toggle_", True),
+    ("eq", "admin_delete_product", True), ("prefix", "delproduct_", True),
+    ("eq", "admin_cards", True), ("prefix", "addcards_", True), ("eq", "admin_broadcast", True),
+)
+
+
+def _old_dispatch(data):
+    # 原实现：逐个分支比较，管理员分支每次都检查权限，命中后 split("_") 取参数
+    for how, key, admin in _OLD_CHAIN:
+        if (data == key if how == "eq" else data.startswith(key)) and (not admin or USER_ID in config.ADMIN_IDS):
+            return key, data[len(key):].split("_") if how == "prefix" else ()
+    return None
+
+
+def _new_dispatch(data):
+    action, args = callbacks.decode(data)
+    entry = callbacks.routes.get(action)
+    if entry is None or (entry[1] and USER_ID not in config.ADMIN_IDS):
+        return None
+    return entry[0], args
+
+
+def _bench(fn, arg, n):
+    began = time.perf_counter()
+    for _ in range(n):
+        fn(arg)
+    return (time.perf_counter() - began) / n * 1e6
+
+
+def main(n=200000):
+    config.ADMIN_IDS = [USER_ID]
+    cases = (
+        # (说明, 旧格式, 新格式)
+        ("buy（靠前分支）", "buy_12", callbacks.encode("buy", 12)),
+        ("addcards（靠后分支）", "addcards_12", callbacks.encode("addcards", 12)),
+        ("admin_broadcast（最后分支）", "admin_broadcast", callbacks.encode("admin_broadcast")),
+        ("toggle（两个参数）", "toggle_3_1", callbacks.encode("toggle", 3, 1)),
+    )
+    for name, old, new in cases:
+        assert _old_dispatch(old) is not None and _new_dispatch(new) is not None
+        before = _bench(_old_dispatch, old, n)
+        after = _bench(_new_dispatch, new, n)
+        legacy = _bench(_new_dispatch, old, n)
+        print(f"{name:24s} if/elif 链 {before:5.2f} us/次 | 路由表 {after:5.2f} us/次 | 路由表（旧格式按钮）{legacy:5.2f} us/次")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,53 @@
+"""
+get_product / get_order 热路径微基准：
+对比每次查询新建连接（原实现）与 database.py 的线程级长连接
+
+用法：python tests/bench_hot_paths.py [次数]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+import database as db  # noqa: E402
+
+
+def _per_call_connection(sql, arg):
+    # 原实现：每个函数 sqlite3.connect -> 查询 -> close
+    conn = sqlite3.connect(config.DATABASE)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute(sql, (arg,)).fetchone()
+    conn.close()
+    return row
+
+
+def _bench(fn, arg, n):
+    began = time.perf_counter()
+    for _ in range(n):
+        fn(arg)
+    return (time.perf_counter() - began) / n * 1e6
+
+
+def main(n=20000):
+    with tempfile.TemporaryDirectory() as tmp:
+        config.DATABASE = os.path.join(tmp, "bench.db")
+        db.init_db()
+        pid = db.add_product("bench", "", 5.0, 1)
+        oid = db.create_order(1, "u", pid, "bench", 5.0, 1)
+        cases = (
+            ("get_product", "SELECT * FROM products WHERE id=?", db.get_product, pid),
+            ("get_order", "SELECT * FROM orders WHERE id=?", db.get_order, oid),
+        )
+        for name, sql, fn, arg in cases:
+            before = _bench(lambda a: _per_call_connection(sql, a), arg, n)
+            after = _bench(fn, arg, n)
+            print(f"{name:12s} 每次新建连接 {before:7.1f} us/次 | 长连接 {after:6.1f} us/次 | {before / after:5.1f}x")
+        db.close_all()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+import database as db  # noqa: E402
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """每个测试使用独立的临时数据库"""
+    db.close_all()
+    monkeypatch.setattr(config, "DATABASE", str(tmp_path / "shop.db"))
+    db.init_db()
+    yield db
+    db.close_all()
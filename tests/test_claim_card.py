@@ -0,0 +1,52 @@
+"""
+claim_card 并发压力测试：多个线程同时为不同订单领取同一商品的卡密，
+卡密数少于领取次数，验证没有一张卡密被发给两个订单，库存最终归零
+"""
+import threading
+import time
+
+THREADS = 16
+CLAIMS_PER_THREAD = 250
+CARDS = 2000   # 少于 THREADS * CLAIMS_PER_THREAD
+
+
+def test_concurrent_claims_never_double_deliver(fresh_db):
+    db = fresh_db
+    pid = db.add_product("card", "", 5.0, 1)
+    db.add_cards(pid, [f"card-{i}" for i in range(CARDS)])
+    order_ids = [db.create_order(1, "u", pid, "card", 5.0, 1) for _ in range(THREADS * CLAIMS_PER_THREAD)]
+
+    claimed = []
+    lock = threading.Lock()
+    start = threading.Barrier(THREADS)
+
+    def worker(k):
+        start.wait()
+        for oid in order_ids[k::THREADS]:
+            card = db.claim_card(pid, oid)
+            if card:
+                with lock:
+                    claimed.append((oid, card["id"], card["content"]))
+
+    began = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - began
+    print(f"\n{THREADS * CLAIMS_PER_THREAD} claims, {len(claimed)} delivered, "
+          f"{THREADS * CLAIMS_PER_THREAD / elapsed:.0f} claims/s")
+
+    assert len(claimed) == CARDS
+    assert len({card_id for _, card_id, _ in claimed}) == CARDS
+    assert len({oid for oid, _, _ in claimed}) == CARDS
+    assert db.get_product(pid)["stock_count"] == 0
+
+    conn = db.get_conn()
+    assert conn.execute("SELECT COUNT(*) FROM cards WHERE product_id=? AND used=0", (pid,)).fetchone()[0] == 0
+    # 每张卡密绑定的订单与领取结果一致，领到卡密的订单都已标记发货
+    bound = dict(conn.execute("SELECT id, order_id FROM cards WHERE product_id=?", (pid,)).fetchall())
+    assert all(bound[card_id] == oid for oid, card_id, _ in claimed)
+    delivered = conn.execute("SELECT COUNT(*) FROM orders WHERE status='delivered'").fetchone()[0]
+    assert delivered == CARDS
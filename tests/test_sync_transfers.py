@@ -0,0 +1,57 @@
+"""
+sync_transfers 回归测试：一轮翻页上限内拉不完的突发转账，
+后续几轮应从已拉取的最新区块时间继续，而不是反复重读最早的几页
+"""
+import asyncio
+import time
+
+import async_db as adb
+import bot
+import config
+import tron_payment
+
+PAGE = 200
+TRANSFERS = 1500   # 多于 TRONGRID_MAX_PAGES * PAGE
+
+
+def _fake_chain(now_ms):
+    # 最近 25 分钟内均匀分布的转账，按区块时间正序
+    step = 25 * 60 * 1000 // TRANSFERS
+    return [{"transaction_id": f"tx{i}", "from": "T", "value": 1_000_000 + i,
+             "block_timestamp": now_ms - 25 * 60 * 1000 + i * step} for i in range(TRANSFERS)]
+
+
+def test_burst_is_fully_fetched_across_ticks(fresh_db, monkeypatch):
+    chain = _fake_chain(int(time.time() * 1000))
+    requests = []
+
+    async def fake_page(wallet, min_timestamp, fingerprint=None, limit=PAGE):
+        # 模拟 TronGrid：min_timestamp 起正序分页，fingerprint 为下一页偏移
+        requests.append((min_timestamp, fingerprint))
+        rows = [tx for tx in chain if tx["block_timestamp"] >= min_timestamp]
+        offset = int(fingerprint or 0)
+        page = rows[offset:offset + limit]
+        more = offset + limit < len(rows)
+        return page, (str(offset + limit) if more else None)
+
+    monkeypatch.setattr(tron_payment, "get_usdt_transfers_page_async", fake_page)
+    monkeypatch.setattr(config, "TRONGRID_MAX_PAGES", 5)
+
+    async def run_ticks(n):
+        for _ in range(n):
+            await bot.sync_transfers()
+
+    try:
+        asyncio.run(run_ticks(3))
+    finally:
+        adb.shutdown()
+
+    db = fresh_db
+    stored = db.get_unconsumed_transfers(0)
+    assert len(stored) == TRANSFERS
+    assert {r["tx_id"] for r in stored} == {tx["transaction_id"] for tx in chain}
+    cursor_ts, fingerprint = db.get_scan_cursor()
+    assert cursor_ts == chain[-1]["block_timestamp"]
+    assert fingerprint is None
+    # 第二轮从第一轮拉到的最新时间继续，而不是回到超时窗口起点
+    assert requests[5] == (chain[5 * PAGE - 1]["block_timestamp"], None)
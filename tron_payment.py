@@ -2,15 +2,26 @@
 波场 USDT (TRC20) 收款检测模块
 使用 TronGrid 公共 API 查询链上转账记录
 """
+import asyncio
 import requests
 import time
 import config
 
+try:
+    import httpx  # 随 python-telegram-bot 一起安装
+except ImportError:
+    httpx = None
+
 TRON_USDT_CONTRACT = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"  # TRC20 USDT 合约地址
+TRONGRID_API = "https://api.trongrid.io"
 
-def get_recent_usdt_transfers(wallet_address, limit=20):
-    """获取钱包最近的 USDT TRC20 转账记录"""
-    url = f"https://api.trongrid.io/v1/accounts/{wallet_address}/transactions/trc20"
+# 异步客户端（连接池复用），首次使用时创建
+_async_client = None
+_async_semaphore = None
+
+def _transfers_request(wallet_address, limit, min_timestamp=None, fingerprint=None):
+    """构造 TRC20 转账查询的 (url, headers, params)"""
+    url = f"{TRONGRID_API}/v1/accounts/{wallet_address}/transactions/trc20"
     headers = {}
     if config.TRONGRID_API_KEY:
         headers["TRON-PRO-API-KEY"] = config.TRONGRID_API_KEY
@@ -19,14 +30,93 @@ def get_recent_usdt_transfers(wallet_address, limit=20):
         "contract_address": TRON_USDT_CONTRACT,
         "only_to": "true"
     }
+    if min_timestamp is not None:
+        # 从游标开始按区块时间正序翻页
+        params["min_timestamp"] = min_timestamp
+        params["order_by"] = "block_timestamp,asc"
+    if fingerprint:
+        params["fingerprint"] = fingerprint
+    return url, headers, params
+
+def _parse_page(data):
+    """返回 (转账列表, 下一页 fingerprint)；没有下一页时 fingerprint 为 None"""
+    return data.get("data", []), data.get("meta", {}).get("fingerprint") or None
+
+def get_recent_usdt_transfers(wallet_address, limit=20):
+    """获取钱包最近的 USDT TRC20 转账记录（同步阻塞版，仅作回退使用）"""
+    url, headers, params = _transfers_request(wallet_address, limit)
     try:
-        resp = requests.get(url, headers=headers, params=params, timeout=10)
+        resp = requests.get(url, headers=headers, params=params, timeout=config.TRONGRID_TIMEOUT)
+        resp.raise_for_status()
         data = resp.json()
         return data.get("data", [])
     except Exception as e:
         print(f"[TronGrid] 查询失败: {e}")
         return []
 
+def get_usdt_transfers_page(wallet_address, min_timestamp, fingerprint=None, limit=200):
+    """
+    从 min_timestamp（毫秒）起正序获取一页转账（同步阻塞版，仅作回退使用）
+    返回 (转账列表, 下一页 fingerprint)；请求失败返回 None
+    """
+    url, headers, params = _transfers_request(wallet_address, limit, min_timestamp, fingerprint)
+    try:
+        resp = requests.get(url, headers=headers, params=params, timeout=config.TRONGRID_TIMEOUT)
+        # 429 / 5xx 也可能带 JSON 正文，不能当作空的最后一页
+        resp.raise_for_status()
+        return _parse_page(resp.json())
+    except Exception as e:
+        print(f"[TronGrid] 查询失败: {e}")
+        return None
+
+def _get_async_client():
+    global _async_client, _async_semaphore
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(config.TRONGRID_TIMEOUT, connect=5),
+            limits=httpx.Limits(max_connections=config.TRONGRID_MAX_CONCURRENCY,
+                                max_keepalive_connections=config.TRONGRID_MAX_CONCURRENCY,
+                                keepalive_expiry=60),
+        )
+        _async_semaphore = asyncio.Semaphore(config.TRONGRID_MAX_CONCURRENCY)
+    return _async_client
+
+async def get_usdt_transfers_page_async(wallet_address, min_timestamp, fingerprint=None, limit=200):
+    """
+    get_usdt_transfers_page 的异步版本，不阻塞事件循环
+    复用长连接，并发数受 TRONGRID_MAX_CONCURRENCY 限制；
+    未安装 httpx 时回退到线程池中执行同步版本
+    """
+    if httpx is None:
+        return await asyncio.to_thread(get_usdt_transfers_page, wallet_address, min_timestamp, fingerprint, limit)
+    client = _get_async_client()
+    url, headers, params = _transfers_request(wallet_address, limit, min_timestamp, fingerprint)
+    try:
+        async with _async_semaphore:
+            resp = await client.get(url, headers=headers, params=params)
+        resp.raise_for_status()
+        return _parse_page(resp.json())
+    except Exception as e:
+        print(f"[TronGrid] 查询失败: {e}")
+        return None
+
+def parse_transfer(tx):
+    """TronGrid 转账记录 -> (tx_id, from_address, amount_micro, block_timestamp)，解析失败返回 None"""
+    try:
+        return (tx["transaction_id"], tx.get("from", ""),
+                int(tx.get("value", 0)), int(tx.get("block_timestamp", 0)))
+    except Exception as e:
+        print(f"[TronGrid] 解析交易异常: {e}")
+        return None
+
+async def close_async_client():
+    """关闭异步客户端连接池（机器人退出时调用）"""
+    global _async_client, _async_semaphore
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+        _async_semaphore = None
+
 def check_payment(order_id, expected_amount, created_timestamp):
     """
     检查是否收到对应金额的 USDT
@@ -41,10 +131,73 @@ def check_payment(order_id, expected_amount, created_timestamp):
             tx_time = int(tx.get("block_timestamp", 0)) / 1000  # 毫秒转秒
             if tx_time < created_timestamp:
                 continue
-            value = int(tx.get("value", 0)) / 1_000_000  # USDT 精度 6
-            if abs(value - expected_amount) <= config.AMOUNT_TOLERANCE:
-                print(f"[订单#{order_id}] 检测到到账 {value} USDT")
+            value = int(tx.get("value", 0))  # 微 USDT，精度 6
+            if value == to_micro(expected_amount):
+                print(f"[订单#{order_id}] 检测到到账 {format_amount(value)} USDT")
                 return True
         except Exception as e:
             print(f"[TronGrid] 解析交易异常: {e}")
     return False
+
+# ===== 应付金额分配 =====
+# 待支付订单的唯一应付金额索引 {应付金额(微 USDT 整数): order_id}
+# 同价商品的并发订单通过尾数区分，到账匹配只需一次字典查找
+_reserved_amounts = {}
+
+def to_micro(amount):
+    """USDT 金额转为微 USDT 整数（链上精度 6 位）"""
+    return int(round(float(amount) * 1_000_000))
+
+def format_amount(micro):
+    """微 USDT 整数转为展示用字符串，去掉多余的 0"""
+    return f"{micro / 1_000_000:.6f}".rstrip("0").rstrip(".")
+
+def allocate_amount(price):
+    """
+    为新订单分配唯一应付金额：商品价格 + n × AMOUNT_STEP
+    返回微 USDT 整数；所有尾数都被占用时返回 None
+    分配后立即占位，拿到订单号后调用 assign_amount 绑定
+    """
+    base = to_micro(price)
+    step = to_micro(config.AMOUNT_STEP)
+    for n in range(config.AMOUNT_SLOTS):
+        micro = base + n * step
+        if micro not in _reserved_amounts:
+            _reserved_amounts[micro] = None
+            return micro
+    return None
+
+def assign_amount(micro, order_id):
+    _reserved_amounts[micro] = order_id
+
+def restore_amount(micro, order_id):
+    """重启后恢复已有订单的应付金额占位；金额已被占用时返回 False"""
+    if micro in _reserved_amounts:
+        return False
+    _reserved_amounts[micro] = order_id
+    return True
+
+def release_amount(micro, order_id=None):
+    """订单付款、取消或超时后释放应付金额（只释放该订单自己占用的金额）"""
+    if _reserved_amounts.get(micro) == order_id:
+        _reserved_amounts.pop(micro, None)
+
+def match_transfers(transfers, pending):
+    """
+    将一批转账与全部待支付订单一次性匹配
+    transfers: transfers 表中未使用的转账记录
+    pending: {order_id: {"created_ts": 创建时间戳, ...}}
+    按转账金额在应付金额索引中直接查找订单，每笔转账最多匹配一个订单
+    返回: [(order_id, tx_id), ...]
+    """
+    matched = []
+    seen = set()
+    for tx in transfers:
+        order_id = _reserved_amounts.get(tx['amount_micro'])
+        info = pending.get(order_id)
+        if info is None or order_id in seen or tx['block_timestamp'] / 1000 < info['created_ts']:
+            continue
+        print(f"[订单#{order_id}] 检测到到账 {format_amount(tx['amount_micro'])} USDT")
+        seen.add(order_id)
+        matched.append((order_id, tx['tx_id']))
+    return matched